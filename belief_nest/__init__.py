@@ -1,4 +1,5 @@
 from .belief_nest_wrapper import BeliefNestWrapper
+from .async_belief_nest_wrapper import AsyncBeliefNestWrapper
 from .llm import coding_llm, llm
 from .llm import planning_llm, check_llm, reflect_llm, replanning_llm, intention_llm
 from .version import __version__
\ No newline at end of file
@@ -0,0 +1,313 @@
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from logging import INFO
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+import belief_nest.utils as U
+from belief_nest.belief_nest_wrapper import BeliefNestWrapper, _create_wrapper_logger
+from belief_nest.observation_loader import unregister_loader, load_from_template
+
+
+class AsyncBeliefNestWrapper(BeliefNestWrapper):
+    """
+    asyncio version of BeliefNestWrapper. The methods that talk to the
+    JavaScript server are coroutines, so independent operations on different
+    belief paths can be run with asyncio.gather. Templates are rendered in a
+    thread pool, so that loading checkpoints does not block the event loop.
+
+        async with AsyncBeliefNestWrapper(config=config, initial_state=initial_state) as bn:
+            await asyncio.gather(
+                bn.execute("/anne/", "anne", code1),
+                bn.execute("/sally/", "sally", code2),
+            )
+    """
+
+    def __init__(
+        self,
+        resume=False,
+        config=None,
+        initial_state=None,
+        mf_server_host="localhost",
+        mf_server_port=3000,
+        mc_host="localhost",
+        mc_port=25565,
+        mq_host="localhost",
+        ckpt_dir="ckpt",
+        log_dir="logs",
+        logger=None,
+        log_level=INFO,
+        loader_options=None,
+        http_pool_size=10,
+        http_timeout=None,
+        wait_mode="sleep",
+        quiet_ticks=20,
+        executor=None,
+    ):
+        if httpx is None:
+            raise ImportError("AsyncBeliefNestWrapper requires httpx. Install it with `pip install .[async]`.")
+
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=http_pool_size, max_keepalive_connections=http_pool_size),
+            timeout=http_timeout,
+        )
+        self.http_timeout = http_timeout
+        # renders templates, i.e. reads and replays checkpoints
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(thread_name_prefix="belief-nest-loader")
+        self.logger = _create_wrapper_logger(log_dir, logger, log_level)
+
+        self._setup_args = self._init_local(
+            resume=resume,
+            config=config,
+            initial_state=initial_state,
+            mf_server_host=mf_server_host,
+            mf_server_port=mf_server_port,
+            mc_host=mc_host,
+            mc_port=mc_port,
+            mq_host=mq_host,
+            ckpt_dir=ckpt_dir,
+            log_dir=log_dir,
+            log_level=log_level,
+            loader_options=loader_options,
+            wait_mode=wait_mode,
+            quiet_ticks=quiet_ticks,
+        )
+        self._started = False
+
+    async def start(self):
+        """
+        Send the setup request. Called by `async with`.
+        """
+        if self._started:
+            return
+        res = await self._post("setup", self._setup_args)
+        if res.status_code != 200:
+            await self._run_in_executor(self.js_process.stop)
+            self._handle_error(res)
+        self._started = True
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def create_sim(self, belief_path, agent_name, offset, player_prefix, mc_host=None, mc_port=None):
+        args = {
+            "beliefPath": belief_path,
+            "agentName": agent_name,
+            "offset": offset,
+            "playerPrefix": player_prefix,
+            "mcHost": mc_host,
+            "mcPort": mc_port
+        }
+        await self._post_checked("createSim", args)
+
+    async def remove_sim(self, belief_path):
+        await self._post_checked("removeSim", {"beliefPath": belief_path})
+
+    async def execute(self, belief_path, agent_name, code, start_stop_observation=True, wait_sec=4, wait_mode=None):
+        if start_stop_observation:
+            await self._start_observation(belief_path)
+
+        args = {
+            "beliefPath": belief_path,
+            "agentName": agent_name,
+            "code": code,
+            "primitives": self.primitives
+        }
+        res = await self._post_checked("execute", args)
+
+        await self._wait_completion(belief_path, wait_sec, wait_mode)
+
+        if start_stop_observation:
+            await self._stop_observation(belief_path)
+
+        data = U.json_loads(res.content)
+        return data["success"], data["errorMsg"]
+
+    async def execute_mc_commands(self, belief_path, agent_name, commands, start_stop_observation=True, wait_sec=1, wait_mode=None):
+        if start_stop_observation:
+            await self._start_observation(belief_path)
+
+        args = {
+            "beliefPath": belief_path,
+            "agentName": agent_name,
+            "commands": commands
+        }
+        await self._post_checked("execMcCommands", args)
+
+        await self._wait_completion(belief_path, wait_sec, wait_mode)
+
+        if start_stop_observation:
+            await self._stop_observation(belief_path)
+
+    async def execute_mc_commands_by_admin(self, belief_path, commands):
+        await self._post_checked("execMcCommandsByAdmin", {"beliefPath": belief_path, "commands": commands})
+
+    async def switch_branch(self, belief_path, branch_name):
+        await self._post_checked("switchBranch", {"beliefPath": belief_path, "branchName": branch_name})
+
+    async def overwrite_belief(self, belief_path, blocks=[], chests=[]):
+        args = {
+            "beliefPath": belief_path,
+            "blockState": blocks,
+            "chestState": chests,
+        }
+        res = await self._post_checked("overwriteState", args)
+        response = U.json_loads(res.content)
+        return response["success"], response["errorMsg"]
+
+    async def chat(self, belief_path, agent_name, msg, silent=False, start_stop_observation=True, wait_sec=2, wait_mode=None):
+        args = {
+            "beliefPath": belief_path,
+            "agentName": agent_name,
+            "msg": msg,
+            "silent": silent,
+        }
+
+        if start_stop_observation:
+            await self._start_observation(belief_path)
+
+        res = await self._post_checked("chat", args)
+
+        await self._wait_completion(belief_path, wait_sec, wait_mode)
+
+        if start_stop_observation:
+            await self._stop_observation(belief_path)
+
+        response = U.json_loads(res.content)
+        return response["success"], response["errorMsg"]
+
+    async def get_branch_str(self, belief_path, dump=True, get_path=False):
+        if await self.sim_exists(belief_path):
+            if dump:
+                # To use branch_str in template, dumping is needed
+                await self._dump_observation(belief_path)
+            info = await self.get_sim_status(belief_path)
+            branch_str = info[0]["branchStr"]
+
+            return_belief_path = belief_path
+
+        else:
+            belief_struct = self._parse_belief_path(belief_path)
+            parent_belief_path = "/" + "/".join(belief_struct[:-1])
+            parent_branch_str, base_belief_path = await self.get_branch_str(parent_belief_path, dump=dump, get_path=True)
+            branch_str = parent_branch_str + f".{belief_struct[-1]}[follow]"
+
+            return_belief_path = base_belief_path
+
+        if get_path:
+            return branch_str, return_belief_path
+
+        return branch_str
+
+    async def sim_exists(self, belief_path):
+        belief_struct = self._parse_belief_path(belief_path)
+
+        for status in await self.get_sim_status():
+            branch_str_struct = status["branchStr"].split(".")[1:]
+            if len(belief_struct) != len(branch_str_struct):
+                continue
+            if all(be == br.split("[")[0] for be, br in zip(belief_struct, branch_str_struct)):
+                return True
+
+        return False
+
+    async def load_from_template(self, belief_path, template, variables={}, extra_filters=[], allow_filter_override=False, dump=True):
+        branch_str, base_belief_path = await self.get_branch_str(belief_path, dump=False, get_path=True)
+        if dump:
+            await self._dump_observation(base_belief_path)
+
+        variables = dict(
+            **variables,
+            **{"branch": branch_str}
+        )
+
+        return await self._run_in_executor(
+            load_from_template,
+            template,
+            variables=variables,
+            extra_filters=extra_filters,
+            allow_filter_override=allow_filter_override,
+            loader=self.observation_loader,
+        )
+
+    async def get_sim_status(self, belief_path=None):
+        args = {} if belief_path is None else {"beliefPath": belief_path}
+        res = await self._post_checked("getSimStatus", args)
+        return U.json_loads(res.content)
+
+    async def get_offset(self, belief_path):
+        res = await self._post_checked("getOffset", {"beliefPath": belief_path})
+        return tuple(U.json_loads(res.content)["offset"])
+
+    async def close(self, clear_env=True):
+        if clear_env:
+            await self._post_checked("close", {})
+
+        await self._run_in_executor(self.js_process.stop)
+        unregister_loader(self.observation_loader)
+        await self.http_client.aclose()
+
+        for key in self.mq_channels:
+            self.mq_channels[key].stop_consuming()
+
+        for key in self.mq_channel_threads:
+            await self._run_in_executor(self.mq_channel_threads[key].join)
+
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+    async def _start_observation(self, belief_path):
+        await self._post_checked("startObservation", {"beliefPath": belief_path})
+
+    async def _stop_observation(self, belief_path):
+        await self._post_checked("stopObservation", {"beliefPath": belief_path})
+
+    async def _wait_completion(self, belief_path, wait_sec, wait_mode=None):
+        args = self._quiescence_args(belief_path, wait_sec, wait_mode)
+        if args is not None:
+            res = await self._post("waitObservationQuiescence", args, timeout=self._long_poll_timeout(wait_sec))
+            if self._settled(res):
+                return
+        await asyncio.sleep(wait_sec)
+
+    async def _dump_observation(self, belief_path, recursive=False):
+        await self._post_checked("dumpObservation", {"beliefPath": belief_path, "recursive": recursive})
+
+    async def _run_in_executor(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def _post(self, endpoint, args, timeout=None):
+        """
+        Args:
+            timeout: timeout of this request, or None for the timeout of the client
+        """
+        start = time.perf_counter()
+        ok = False
+        try:
+            res = await self.http_client.post(
+                f"{self.server_addr}/{endpoint}",
+                content=U.json_dumps(args).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+                timeout=httpx.USE_CLIENT_DEFAULT if timeout is None else timeout,
+            )
+            ok = res.status_code == 200
+            return res
+        finally:
+            self._record_latency(endpoint, time.perf_counter() - start, ok)
+
+    async def _post_checked(self, endpoint, args):
+        res = await self._post(endpoint, args)
+        if res.status_code != 200:
+            self._handle_error(res)
+        return res
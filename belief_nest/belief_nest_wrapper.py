@@ -1,12 +1,12 @@
 import os
 import time
-import json
 import yaml
 from pathlib import Path
 from logging import FileHandler, Formatter, INFO
 from datetime import datetime
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
 import atexit
 import pika
 import threading
@@ -15,10 +15,25 @@ from .utils import create_logger, MethodLogging
 
 import belief_nest.utils as U
 from belief_nest.env.process_monitor import SubprocessMonitor
-from belief_nest.observation_loader import initialize_observation_loader, load_from_template
+from belief_nest.observation_loader import initialize_observation_loader, unregister_loader, load_from_template
 from belief_nest.primitives import load_primitives
 
 
+def _create_wrapper_logger(log_dir, logger, log_level):
+    if logger:
+        if log_level:
+            logger.warning("log_level is ignored because logger is given.")
+        return logger
+
+    timestr = datetime.now().strftime('%Y%m%d_%H%M%S')
+    log_file = Path(f'{os.path.abspath(log_dir)}/bn_wrapper_{timestr}.log')
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    handler = FileHandler(filename=log_file, encoding="utf-8")
+    formatter = Formatter('%(asctime)s ; %(name)s ; %(levelname)s ; %(message)s')
+    handler.setFormatter(formatter)
+    return create_logger("ctrlr", handler=handler, level=log_level)
+
+
 class BeliefNestWrapper(MethodLogging):
     def __init__(
         self,
@@ -34,36 +49,83 @@ class BeliefNestWrapper(MethodLogging):
         log_dir="logs",
         logger=None,
         log_level=INFO,
+        loader_options=None,
+        http_pool_size=10,
+        http_timeout=None,
+        wait_mode="sleep",
+        quiet_ticks=20,
+    ):
+        # one keep-alive session for all calls to the mineflayer server
+        self.http_session = requests.Session()
+        self.http_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size))
+        self.http_timeout = http_timeout
+        self.logger = _create_wrapper_logger(log_dir, logger, log_level)
+
+        setup_args = self._init_local(
+            resume=resume,
+            config=config,
+            initial_state=initial_state,
+            mf_server_host=mf_server_host,
+            mf_server_port=mf_server_port,
+            mc_host=mc_host,
+            mc_port=mc_port,
+            mq_host=mq_host,
+            ckpt_dir=ckpt_dir,
+            log_dir=log_dir,
+            log_level=log_level,
+            loader_options=loader_options,
+            wait_mode=wait_mode,
+            quiet_ticks=quiet_ticks,
+        )
+        res = self._post("setup", setup_args)
+        if res.status_code != 200:
+            self.js_process.stop()
+            self._handle_error(res)
+
+    def _init_local(
+        self,
+        resume,
+        config,
+        initial_state,
+        mf_server_host,
+        mf_server_port,
+        mc_host,
+        mc_port,
+        mq_host,
+        ckpt_dir,
+        log_dir,
+        log_level,
+        loader_options,
+        wait_mode,
+        quiet_ticks,
     ):
+        """
+        Everything of the constructor but the setup request: config files,
+        RabbitMQ, the JavaScript server and the observation loader.
+
+        Returns:
+            arguments of the setup request
+        """
+        if wait_mode not in ["sleep", "quiescence"]:
+            raise ValueError(f"Invalid wait_mode '{wait_mode}'")
+        self.wait_mode = wait_mode
+        self.quiet_ticks = quiet_ticks
         self.server_addr = f"http://{mf_server_host}:{mf_server_port}"
+        self._http_stats = {}
+        self._http_stats_lock = threading.Lock()
         self.ckpt_dir = os.path.abspath(ckpt_dir)
         self.log_dir = os.path.abspath(log_dir)
         self.log_level = log_level
 
         self.primitives = load_primitives()
 
-        if logger:
-            self.logger = logger
-            if log_level:
-                self.logger.warning("log_level is ignored because logger is given.")
-        else:
-            timestr = datetime.now().strftime('%Y%m%d_%H%M%S')
-            log_file = Path(f'{self.log_dir}/bn_wrapper_{timestr}.log')
-            log_file.parent.mkdir(parents=True, exist_ok=True)
-            handler = FileHandler(filename=log_file, encoding="utf-8")
-            formatter = Formatter('%(asctime)s ; %(name)s ; %(levelname)s ; %(message)s')
-            handler.setFormatter(formatter)
-            self.logger = create_logger("ctrlr", handler=handler, level=log_level)
-
         if not resume:
             assert config and initial_state
             world_dir = Path(self.ckpt_dir) / "world[default]"
             world_dir.mkdir(parents=True, exist_ok=True)
 
-            with Path(self.ckpt_dir).joinpath("config.json").open("w") as f:
-                json.dump(config, f, ensure_ascii=False, indent=2)
-            with world_dir.joinpath("state#-1.json").open("w") as f:
-                json.dump(initial_state, f, indent=2)
+            U.json_dump(config, self.ckpt_dir, "config.json", ensure_ascii=False, indent=2)
+            U.json_dump(initial_state, str(world_dir), "state#-1.json", indent=2)
 
         self.mq_connection = pika.BlockingConnection(pika.ConnectionParameters(mq_host))
         self.chat_callbacks = {}
@@ -79,23 +141,18 @@ class BeliefNestWrapper(MethodLogging):
         self.js_process.run()
         atexit.register(self.js_process.stop)
 
-        with Path(self.ckpt_dir).joinpath("config.json").open() as f:
-            agent_names = list(json.load(f)["players"].keys())
+        agent_names = list(U.json_load(self.ckpt_dir, "config.json")["players"].keys())
 
-        initialize_observation_loader(self.ckpt_dir, agent_names)
+        self.observation_loader = initialize_observation_loader(self.ckpt_dir, agent_names, **(loader_options or {}))
 
-        args = {
+        return {
             "mcHost": mc_host,
             "mcPort": mc_port,
             "mqHost": mq_host,
             "ckptDir": self.ckpt_dir,
             "logDir": self.log_dir
         }
-        res = requests.post(f"{self.server_addr}/setup", json=args)
-        if res.status_code != 200:
-            self.js_process.stop()
-            self._handle_error(res)
-    
+
             
     def create_sim(self, belief_path, agent_name, offset, player_prefix, mc_host=None, mc_port=None):
         args = {
@@ -106,7 +163,7 @@ class BeliefNestWrapper(MethodLogging):
             "mcHost": mc_host,
             "mcPort": mc_port
         }
-        res = requests.post(f"{self.server_addr}/createSim", json=args)
+        res = self._post("createSim", args)
         if res.status_code != 200:
             self._handle_error(res)
         
@@ -114,11 +171,11 @@ class BeliefNestWrapper(MethodLogging):
         args = {
             "beliefPath": belief_path
         }
-        res = requests.post(f"{self.server_addr}/removeSim", json=args)
+        res = self._post("removeSim", args)
         if res.status_code != 200:
             self._handle_error(res)
         
-    def execute(self, belief_path, agent_name, code, start_stop_observation=True, wait_sec=4):
+    def execute(self, belief_path, agent_name, code, start_stop_observation=True, wait_sec=4, wait_mode=None):
         if start_stop_observation:
             self._start_observation(belief_path)
 
@@ -128,19 +185,19 @@ class BeliefNestWrapper(MethodLogging):
             "code": code,
             "primitives": self.primitives
         }
-        res = requests.post(f"{self.server_addr}/execute", json=args)
+        res = self._post("execute", args)
         if res.status_code != 200:
             self._handle_error(res)
 
-        time.sleep(wait_sec)
+        self._wait_completion(belief_path, wait_sec, wait_mode)
         
         if start_stop_observation:
             self._stop_observation(belief_path)
 
-        data = res.json()
+        data = U.json_loads(res.content)
         return data["success"], data["errorMsg"]
         
-    def execute_mc_commands(self, belief_path, agent_name, commands, start_stop_observation=True, wait_sec=1):
+    def execute_mc_commands(self, belief_path, agent_name, commands, start_stop_observation=True, wait_sec=1, wait_mode=None):
         if start_stop_observation:
             self._start_observation(belief_path)
 
@@ -149,11 +206,11 @@ class BeliefNestWrapper(MethodLogging):
             "agentName": agent_name,
             "commands": commands
         }
-        res = requests.post(f"{self.server_addr}/execMcCommands", json=args)
+        res = self._post("execMcCommands", args)
         if res.status_code != 200:
             self._handle_error(res)
         
-        time.sleep(wait_sec)
+        self._wait_completion(belief_path, wait_sec, wait_mode)
         
         if start_stop_observation:
             self._stop_observation(belief_path)
@@ -163,7 +220,7 @@ class BeliefNestWrapper(MethodLogging):
             "beliefPath": belief_path,
             "commands": commands
         }
-        res = requests.post(f"{self.server_addr}/execMcCommandsByAdmin", json=args)
+        res = self._post("execMcCommandsByAdmin", args)
         if res.status_code != 200:
             self._handle_error(res)
 
@@ -172,7 +229,7 @@ class BeliefNestWrapper(MethodLogging):
             "beliefPath": belief_path,
             "branchName": branch_name
         }
-        res = requests.post(f"{self.server_addr}/switchBranch", json=args)
+        res = self._post("switchBranch", args)
         if res.status_code != 200:
             self._handle_error(res)
 
@@ -184,17 +241,17 @@ class BeliefNestWrapper(MethodLogging):
             "chestState": chests,
             #"agentState": agents,
         }
-        res = requests.post(f"{self.server_addr}/overwriteState", json=args)
+        res = self._post("overwriteState", args)
         if res.status_code != 200:
             self._handle_error(res)
-        response = res.json()
+        response = U.json_loads(res.content)
 
         success = response["success"]
         error_msg = response["errorMsg"]
 
         return success, error_msg
     
-    def chat(self, belief_path, agent_name, msg, silent=False, start_stop_observation=True, wait_sec=2):
+    def chat(self, belief_path, agent_name, msg, silent=False, start_stop_observation=True, wait_sec=2, wait_mode=None):
         args = {
             "beliefPath": belief_path,
             "agentName": agent_name,
@@ -205,16 +262,16 @@ class BeliefNestWrapper(MethodLogging):
         if start_stop_observation:
             self._start_observation(belief_path)
 
-        res = requests.post(f"{self.server_addr}/chat", json=args)
+        res = self._post("chat", args)
         if res.status_code != 200:
             self._handle_error(res)
 
-        time.sleep(wait_sec)
+        self._wait_completion(belief_path, wait_sec, wait_mode)
         
         if start_stop_observation:
             self._stop_observation(belief_path)
 
-        response = res.json()
+        response = U.json_loads(res.content)
         success = response["success"]
         error_msg = response["errorMsg"]
 
@@ -293,36 +350,38 @@ class BeliefNestWrapper(MethodLogging):
             **{"branch": branch_str}
         )
 
-        return load_from_template(template, variables=variables, extra_filters=extra_filters, allow_filter_override=allow_filter_override)
+        return load_from_template(template, variables=variables, extra_filters=extra_filters, allow_filter_override=allow_filter_override, loader=self.observation_loader)
     
     def get_sim_status(self, belief_path=None):
         if belief_path is None:
             args = {}
         else:
             args = {"beliefPath": belief_path}
-        res = requests.post(f"{self.server_addr}/getSimStatus", json=args)
+        res = self._post("getSimStatus", args)
         if res.status_code != 200:
             self._handle_error(res)
         
-        return res.json()
+        return U.json_loads(res.content)
     
     def get_offset(self, belief_path):
         args = {"beliefPath": belief_path}
-        res = requests.post(f"{self.server_addr}/getOffset", json=args)
+        res = self._post("getOffset", args)
         if res.status_code != 200:
             self._handle_error(res)
 
-        response = res.json()
+        response = U.json_loads(res.content)
         
         return tuple(response["offset"])
     
     def close(self, clear_env=True):
         if clear_env:
-            res = requests.post(f"{self.server_addr}/close", json={})
+            res = self._post("close", {})
             if res.status_code != 200:
                 self._handle_error(res)
 
         self.js_process.stop()
+        unregister_loader(self.observation_loader)
+        self.http_session.close()
 
         for key in self.mq_channels:
             self.mq_channels[key].stop_consuming()
@@ -353,7 +412,7 @@ class BeliefNestWrapper(MethodLogging):
         args = {
             "beliefPath": belief_path,
         }
-        res = requests.post(f"{self.server_addr}/startObservation", json=args)
+        res = self._post("startObservation", args)
         if res.status_code != 200:
             self._handle_error(res)
         
@@ -361,16 +420,70 @@ class BeliefNestWrapper(MethodLogging):
         args = {
             "beliefPath": belief_path,
         }
-        res = requests.post(f"{self.server_addr}/stopObservation", json=args)
+        res = self._post("stopObservation", args)
         if res.status_code != 200:
             self._handle_error(res)
         
+    def _wait_completion(self, belief_path, wait_sec, wait_mode=None):
+        """
+        Wait for the world to settle after an action. "sleep" waits wait_sec
+        seconds. "quiescence" returns as soon as the server has observed no new
+        event for `quiet_ticks` ticks, waiting wait_sec seconds at most.
+        """
+        args = self._quiescence_args(belief_path, wait_sec, wait_mode)
+        if args is not None:
+            res = self._post("waitObservationQuiescence", args, timeout=self._long_poll_timeout(wait_sec))
+            if self._settled(res):
+                return
+        time.sleep(wait_sec)
+
+    def _quiescence_args(self, belief_path, wait_sec, wait_mode=None):
+        """
+        Returns:
+            args of waitObservationQuiescence, or None if wait_mode is "sleep"
+        """
+        wait_mode = wait_mode or self.wait_mode
+        if wait_mode == "sleep":
+            return None
+        if wait_mode != "quiescence":
+            raise ValueError(f"Invalid wait_mode '{wait_mode}'")
+
+        return {
+            "beliefPath": belief_path,
+            "quietTicks": self.quiet_ticks,
+            "timeoutMs": int(wait_sec * 1000),
+        }
+
+    def _long_poll_timeout(self, wait_sec):
+        """
+        Timeout of waitObservationQuiescence, which the server holds for up to
+        wait_sec seconds: http_timeout, with a read timeout of at least wait_sec
+        plus a margin.
+        """
+        if self.http_timeout is None:
+            return None
+        if isinstance(self.http_timeout, tuple):
+            connect, read = self.http_timeout
+        else:
+            connect = read = self.http_timeout
+        return (connect, max(read, wait_sec + 5))
+
+    def _settled(self, res):
+        """
+        Returns:
+            whether the waitObservationQuiescence response ends the wait. False
+            if observation is not running, as there is no signal to wait for.
+        """
+        if res.status_code != 200:
+            self._handle_error(res)
+        return U.json_loads(res.content)["observing"]
+
     def _dump_observation(self, belief_path, recursive=False):
         args = {
             "beliefPath": belief_path,
             "recursive": recursive
         }
-        res = requests.post(f"{self.server_addr}/dumpObservation", json=args)
+        res = self._post("dumpObservation", args)
         if res.status_code != 200:
             self._handle_error(res)   
 
@@ -380,7 +493,7 @@ class BeliefNestWrapper(MethodLogging):
 
         def on_message(ch, method, properties, body):
             try:
-                data = json.loads(body)
+                data = U.json_loads(body)
                 for callback_dict in self.chat_callbacks[belief_path]:
                     callback = callback_dict["callback"]
                     kwargs = callback_dict["kwargs"]
@@ -409,9 +522,48 @@ class BeliefNestWrapper(MethodLogging):
         parent_agent_names = [p for p in belief_path.split("/") if p]
         return "-".join(parent_agent_names) + "_chat"
         
+    def http_stats(self):
+        """
+        Returns:
+            endpoint -> {"count", "errors", "total_sec", "mean_sec", "max_sec"}
+            of the requests to the mineflayer server so far
+        """
+        with self._http_stats_lock:
+            return {
+                endpoint: dict(stats, mean_sec=stats["total_sec"] / stats["count"] if stats["count"] else 0.0)
+                for endpoint, stats in self._http_stats.items()
+            }
+
+    def _post(self, endpoint, args, timeout=None):
+        """
+        Args:
+            timeout: timeout of this request, or None for http_timeout
+        """
+        start = time.perf_counter()
+        ok = False
+        try:
+            res = self.http_session.post(
+                f"{self.server_addr}/{endpoint}",
+                data=U.json_dumps(args).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+                timeout=self.http_timeout if timeout is None else timeout,
+            )
+            ok = res.status_code == 200
+            return res
+        finally:
+            self._record_latency(endpoint, time.perf_counter() - start, ok)
+
+    def _record_latency(self, endpoint, sec, ok):
+        with self._http_stats_lock:
+            stats = self._http_stats.setdefault(endpoint, {"count": 0, "errors": 0, "total_sec": 0.0, "max_sec": 0.0})
+            stats["count"] += 1
+            stats["errors"] += not ok
+            stats["total_sec"] += sec
+            stats["max_sec"] = max(stats["max_sec"], sec)
+
     def _handle_error(self, res):
         status_code = res.status_code
-        data = res.json()
+        data = U.json_loads(res.content)
         error_msg = data.get("errorMsg", "")
 
         msg = f"Javascript server replies with code {status_code}."
@@ -0,0 +1,102 @@
+"""
+Convert checkpoint files (state#T, history#T and their .internal counterparts)
+between json and the compact npz encoding of utils/ckpt_codec.py.
+
+    python -m belief_nest.ckpt_converter to-npz <ckpt_dir> [--keep]
+    python -m belief_nest.ckpt_converter to-json <ckpt_dir> [--keep]
+
+ObservationLoader reads both encodings. The mineflayer server reads json
+only, so convert a checkpoint back to json before the server resumes from it.
+"""
+import os
+import re
+import sys
+import json
+import argparse
+
+from .utils.json_utils import json_loads
+from .utils.ckpt_codec import dump_ckpt_npz, load_ckpt_npz
+
+
+CKPT_FILE_REGEX = re.compile(r"^(?:[a-zA-Z0-9_]+#)?(?:state|history)#-?\d+\.(json|npz)$")
+
+
+def iter_ckpt_files(ckpt_dir, ext):
+    """
+    Yields paths of the checkpoint files with extension `ext` ("json" or "npz") under ckpt_dir.
+    """
+    for root, dirs, files in os.walk(ckpt_dir):
+        # keyframes are a cache of the loader, not checkpoint files
+        dirs[:] = sorted(d for d in dirs if d != ".keyframes")
+        for filename in sorted(files):
+            match = CKPT_FILE_REGEX.match(filename)
+            if match and match.group(1) == ext:
+                yield os.path.join(root, filename)
+
+
+def convert_file(filepath, to, keep=False):
+    """
+    Args:
+        to: "npz" or "json"
+        keep: keep the source file
+
+    Returns:
+        path of the converted file
+    """
+    base, _ = os.path.splitext(filepath)
+    dst_filepath = f"{base}.{to}"
+    tmp_filepath = dst_filepath + ".tmp"
+
+    if to == "npz":
+        with open(filepath, "rb") as f:
+            obj = json_loads(f.read())
+        with open(tmp_filepath, "wb") as f:
+            dump_ckpt_npz(obj, f)
+    elif to == "json":
+        obj = load_ckpt_npz(filepath)
+        with open(tmp_filepath, "w", encoding="utf-8") as f:
+            # same layout as the files written by the mineflayer server
+            json.dump(obj, f, indent="\t", ensure_ascii=False)
+    else:
+        raise ValueError(f"Invalid target encoding '{to}'")
+
+    os.replace(tmp_filepath, dst_filepath)
+    if not keep:
+        os.remove(filepath)
+    return dst_filepath
+
+
+def convert_ckpt_dir(ckpt_dir, to, keep=False, verbose=False):
+    """
+    Returns:
+        (total size of the source files, total size of the converted files)
+    """
+    src_ext = {"npz": "json", "json": "npz"}[to]
+    src_size = dst_size = 0
+    for filepath in list(iter_ckpt_files(ckpt_dir, src_ext)):
+        size = os.path.getsize(filepath)
+        dst_filepath = convert_file(filepath, to, keep=keep)
+        src_size += size
+        dst_size += os.path.getsize(dst_filepath)
+        if verbose:
+            print(f"{filepath} -> {dst_filepath}")
+    return src_size, dst_size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert BeliefNest checkpoint files between json and npz.")
+    parser.add_argument("to", choices=["to-npz", "to-json"])
+    parser.add_argument("ckpt_dir")
+    parser.add_argument("--keep", action="store_true", help="keep the source files")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.ckpt_dir):
+        parser.error(f"'{args.ckpt_dir}' is not a directory")
+
+    src_size, dst_size = convert_ckpt_dir(args.ckpt_dir, args.to[len("to-"):], keep=args.keep, verbose=args.verbose)
+    print(f"{src_size} bytes -> {dst_size} bytes", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -703,6 +703,10 @@ class BeliefSimulator{
         await this.adminBot.controlObservation({subcommand:"stop"});
     }
 
+    async waitObservationQuiescence({quietTicks, timeoutMs}={}){
+        return await this.adminBot.controlObservation({subcommand:"waitQuiescence", args:{quietTicks, timeoutMs}});
+    }
+
     async dumpObservation({recursive=false, stop=false}={}){
         if(recursive){
             const promises = [];
@@ -445,6 +445,7 @@ async function observation(argObj){
         case "dump":   responseData = await obsManager.dump(args); break;
         case "load":   await obsManager.load(args); break;
         case "setStopFollowTick": await obsManager.setStopFollowTick(args); break;
+        case "waitQuiescence": responseData = await obsManager.waitQuiescence(args); break;
         case "updateBranchCkptDir": await obsManager.updateBranchCkptDir(args); break;
         case "overwriteState": responseData = await obsManager.overwriteState(args); break;
         default: new Error(`Subcommand "${subcommand}" does not exist for observation.`)
@@ -56,6 +56,7 @@ class ObservationManager{
         this.isSending = false;
 
         this.globalTick = null;
+        this.lastEventTick = null;  // last tick with an observed event, for waitQuiescence()
 
         this.nonExistentAgentNames = [];
         
@@ -151,6 +152,7 @@ class ObservationManager{
         switch(this.mode){
             case "observe":
                 this.globalTick++;
+                this.lastEventTick = this.globalTick;
                 this.bot.on('physicsTick', this.observeBound);
                 for(const eventInstance of Object.values(this.eventInstances)){
                     eventInstance.start();
@@ -705,6 +707,7 @@ class ObservationManager{
             }
 
             if(events.length){
+                this.lastEventTick = globalTick;
                 this.logger.info(`${events.length} event(s) detected`);
                 for(const e of events){
                     this.logger.trace(`detected event: ${dumpToJson(e)}`);
@@ -1164,6 +1167,27 @@ class ObservationManager{
         return filteredEvents;
     }
 
+    async waitQuiescence({quietTicks=20, timeoutMs=10000}={}){
+        // Resolves once the event caches are empty and no event has been observed
+        // for quietTicks ticks, or after timeoutMs. observing=false if observation
+        // is not running, so there is nothing to wait for.
+        const startTime = Date.now();
+        while(true){
+            if(this.mode !== "observe" || !this.isSchedulerActive){
+                return {observing: false, quiescent: false, tick: this.globalTick, lastEventTick: this.lastEventTick};
+            }
+            const cacheEmpty = Object.values(this.eventInstances).every(e => e.cacheLength() === 0);
+            if(cacheEmpty && this.globalTick - this.lastEventTick >= quietTicks){
+                return {observing: true, quiescent: true, tick: this.globalTick, lastEventTick: this.lastEventTick};
+            }
+            if(Date.now() - startTime >= timeoutMs){
+                this.logger.info(`waitQuiescence timed out after ${timeoutMs} ms (tick=${this.globalTick}, lastEventTick=${this.lastEventTick}).`);
+                return {observing: true, quiescent: false, tick: this.globalTick, lastEventTick: this.lastEventTick};
+            }
+            await sleep_ms(10);
+        }
+    }
+
     async setStopFollowTick({tick}){
         this.stopFollowTick = tick;
     }
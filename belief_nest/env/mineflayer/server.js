@@ -265,6 +265,17 @@ app.post("/stopObservation", requireParams(['beliefPath']), asyncWrapper(async (
     res.json();
 }));
 
+app.post("/waitObservationQuiescence", requireParams(['beliefPath']), asyncWrapper(async (req,res)=> {
+    const beliefPath = req.body.beliefPath;
+    const quietTicks = req.body.quietTicks;
+    const timeoutMs = req.body.timeoutMs;
+
+    const sim = getSim(world, beliefPath);
+    const result = await sim.waitObservationQuiescence({quietTicks, timeoutMs});
+
+    res.json(result);
+}));
+
 app.post("/dumpObservation", requireParams(['beliefPath']), asyncWrapper(async (req,res)=> {
     const beliefPath = req.body.beliefPath;
     const recursive = req.body.recursive !== undefined ? req.body.recursive : false;
@@ -472,6 +483,9 @@ app.use((req, res) => {
 // Server listening to PORT 3000
 const DEFAULT_PORT = 3000;
 const PORT = process.argv[2] || DEFAULT_PORT;
-app.listen(PORT, () => {
+const server = app.listen(PORT, () => {
     console.log(`Server started on port ${PORT}`);
 });
+// the python wrapper keeps its connections alive, and calls may be minutes apart
+server.keepAliveTimeout = 10 * 60 * 1000;
+server.headersTimeout = server.keepAliveTimeout + 1000;
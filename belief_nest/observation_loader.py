@@ -3,79 +3,418 @@ import re
 import io
 import json
 import yaml
-from bisect import bisect_left
+from bisect import bisect_left, bisect_right
 import base64
 from pathlib import Path
+from collections.abc import Mapping
 import copy
-import time
+import warnings
+import functools
+import itertools
+import threading
+import contextlib
+import contextvars
 
 from jinja2 import Environment, StrictUndefined, DebugUndefined
 import numpy as np
 
+from .utils import LRUCache, SingleFlight, estimate_size, json_loads, json_dumps
+from .utils.fs_watch import create_dir_watcher
+from .utils.ckpt_codec import is_ckpt_npz, load_ckpt_npz
+
+
+# ckpt_dir -> ObservationLoader, see initialize_observation_loader
+_loaders = {}
+_default_loader = None
+# loader bound by the filters of a jinja environment while they run
+_current_loader = contextvars.ContextVar("observation_loader", default=None)
 
-loader = None
-agent_names = None
-    
 
 class ObservationLoader:
-    def __init__(self, ckpt_dir):
+    """
+    Safe for concurrent use from several threads. Concurrent loads of the same
+    file are coalesced into one parse, and replays of the same agent chain are
+    serialized while other chains proceed in parallel.
+
+    Args:
+        agent_names: names of the agents in the simulation, used by some filters
+        cache: LRUCache of the parsed checkpoint files. Pass the same instance to
+            several loaders to share it, otherwise each loader creates its own
+            bounded by `cache_max_bytes`, the estimated memory of the parsed files.
+        live_ingest: start the background ingest (see start_ingest) with
+            `ingest_interval` seconds between checks for new files
+    """
+
+    def __init__(
+        self,
+        ckpt_dir,
+        agent_names=None,
+        cache=None,
+        cache_max_bytes=512 * 1024 ** 2,
+        dir_cache_max_entries=4096,
+        fs_watch="auto",
+        keyframe_interval=1000,
+        state_snapshot_max_entries=32,
+        visibility_memo_max_bytes=256 * 1024 ** 2,
+        live_ingest=False,
+        ingest_interval=0.5,
+    ):
         self.ckpt_dir = ckpt_dir
-        self.cache = {}
-        self.dir_cache = {}
-        self.exist_cache = {}
+        self.agent_names = agent_names
+        # file cache is bounded by the estimated memory of the parsed files. Its keys are
+        # file paths validated by mtime and size, so it can be shared between loaders
+        self.cache = cache if cache is not None else LRUCache(max_bytes=cache_max_bytes)
+        self.dir_cache = LRUCache(max_entries=dir_cache_max_entries)
+        self.invalidations = 0
+        # invalidates dir_cache entries whose directory has changed
+        self.dir_watcher = create_dir_watcher(fs_watch)
 
         self.statecache = {}
+        # guards statecache, the counters and the creation of chain locks
+        self._lock = threading.Lock()
+        self._dir_lock = threading.Lock()
+        self._chain_locks = {}
+        self._flights = SingleFlight()
+        # bounded by the estimated memory of the entries, see _get_visibility
+        self.visibility_memo = LRUCache(max_bytes=visibility_memo_max_bytes)
+        self._visibility_serials = itertools.count()
+        # derived states of follow branches are saved to disk every `keyframe_interval` ticks
+        self.keyframe_interval = keyframe_interval
+        # Vec3Maps of the states of files, used by diff_states
+        self.vec3map_memo = LRUCache(max_bytes=128 * 1024 ** 2)
+        # event indexes of the states of files, used by the event filters
+        self.event_index_memo = LRUCache(max_entries=64)
+        # past derived states returned by get_state_at, (base_ckpt_dir, agent_list, tick) -> (state, obj_state)
+        self.state_snapshots = LRUCache(max_entries=state_snapshot_max_entries)
+
+        # branches queried so far, kept up to date by the background ingest
+        self._tracked_branches = {}
+        self._ingest_thread = None
+        self._ingest_stop = None
+        self.ingest_rounds = 0
+        self.ingest_errors = 0
+        if live_ingest:
+            self.start_ingest(ingest_interval)
+
+    def close(self):
+        self.stop_ingest()
+        with self._dir_lock:
+            self.dir_watcher.close()
+
+    def start_ingest(self, interval=0.5):
+        """
+        Start a background thread that checks for new state and history files
+        every `interval` seconds and brings the branches queried so far up to
+        date: new files are parsed into the cache and the derived states of
+        follow branches are replayed, so the next query returns without
+        replaying them.
+        """
+        if self._ingest_thread is not None:
+            return
+        self._ingest_stop = threading.Event()
+        self._ingest_thread = threading.Thread(
+            target=self._ingest_loop,
+            args=(interval, self._ingest_stop),
+            name="observation-ingest",
+            daemon=True,
+        )
+        self._ingest_thread.start()
+
+    def stop_ingest(self):
+        if self._ingest_thread is None:
+            return
+        self._ingest_stop.set()
+        self._ingest_thread.join()
+        self._ingest_thread = None
+
+    def _ingest_loop(self, interval, stop):
+        while not stop.wait(interval):
+            self.ingest()
+
+    def ingest(self):
+        """
+        Bring the branches queried so far up to date with the files on disk.
+        Runs in the ingest thread, but can also be called directly.
+        """
+        with self._lock:
+            branch_strs = list(self._tracked_branches)
+        for branch_str in branch_strs:
+            try:
+                # both return right away if nothing has changed
+                self.get_latest_state(branch_str)
+                self.get_latest_history(branch_str)
+            except Exception:
+                # files still being written are retried in the next round
+                with self._lock:
+                    self.ingest_errors += 1
+        with self._lock:
+            self.ingest_rounds += 1
+
+    def _track_branch(self, branch_str):
+        if branch_str not in self._tracked_branches:
+            with self._lock:
+                self._tracked_branches[branch_str] = None
+
+    def _invalidate(self, key):
+        self.cache.pop(key)
+        with self._lock:
+            self.invalidations += 1
+
+    def _chain_lock(self, agent_list_key):
+        with self._lock:
+            return self._chain_locks.setdefault(agent_list_key, threading.Lock())
 
     def _cached_load(self, filepath, filetype, deepcopy=False):
-        if filepath in self.cache:
-            if deepcopy:
-                return copy.deepcopy(self.cache[filepath])
-            else:
-                return self.cache[filepath]
+        stat = os.stat(filepath)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self._cached_get(filepath, signature)
+        if entry is not None:
+            obj = entry["obj"]
+        else:
+            # threads loading the same file at the same time share one parse
+            obj = self._flights.do((filepath, signature), lambda: self._load_file(filepath, filetype, stat))
+
+        if deepcopy:
+            return copy.deepcopy(obj)
+        return obj
+
+    def _load_file(self, filepath, filetype, stat):
+        signature = (stat.st_mtime_ns, stat.st_size)
+        entry = self.cache.peek(filepath)
+        if entry is not None and entry["signature"] == signature:
+            # loaded by another thread in the meantime
+            return entry["obj"]
 
         # Actually open the file and parse its content
-        with open(filepath, "r", encoding="utf-8") as f:
+        if is_ckpt_npz(filepath):
+            obj = load_ckpt_npz(filepath)
+        else:
             if filetype == "yaml":
-                obj = yaml.safe_load(f)
+                with open(filepath, "r", encoding="utf-8") as f:
+                    obj = yaml.safe_load(f)
             elif filetype == "json":
-                obj = json.load(f)
+                with open(filepath, "rb") as f:
+                    obj = json_loads(f.read())
             else:
                 raise ValueError(f"Unsupported filetype: {filetype}")
 
-        # Save the parsed object to the cache
-        self.cache[filepath] = obj
+        # Save the parsed object to the cache, sized by its memory rather than the
+        # file size (parsed json takes about 4 times the bytes of the file)
+        self.cache.put(filepath, {"obj": obj, "signature": signature}, size=estimate_size(obj))
         return obj
+
+    def _cached_get(self, key, signature):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if entry["signature"] != signature:
+            # the file was rewritten after it was cached
+            self._invalidate(key)
+            return None
+        return entry
+
+    def _cached_tick_index(self, filepath, signature):
+        """
+        Byte offsets of the ticks of a history file, built by a streaming scan.
+
+        Returns:
+            {"ticks": [tick, ...], "spans": [(start, end), ...]} sorted by tick, or
+            None if the file is not a tab-indented `__SortedMap__` json
+        """
+        key = ("tick_index", filepath)
+        entry = self._cached_get(key, signature)
+        if entry is None:
+            def scan():
+                with open(filepath, "rb") as f:
+                    index = _scan_sorted_map(f)
+                entry = {"index": index, "signature": signature}
+                self.cache.put(key, entry, size=64 * len(index["ticks"]) if index else 64)
+                return entry
+            entry = self._flights.do(key + (signature,), scan)
+        return entry["index"]
+
+    def _cached_block_vis_ticks(self, filepath):
+        """
+        Returns:
+            sorted ticks of a history file that carry block visibility
+        """
+        stat = os.stat(filepath)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        key = ("block_vis_ticks", filepath)
+        entry = self._cached_get(key, signature)
+        if entry is None:
+            def scan():
+                ticks = self._scan_block_vis_ticks(filepath, signature)
+                entry = {"ticks": ticks, "signature": signature}
+                self.cache.put(key, entry, size=64 * len(ticks) + 64)
+                return entry
+            entry = self._flights.do(key + (signature,), scan)
+        return entry["ticks"]
+
+    def _scan_block_vis_ticks(self, filepath, signature):
+        entry = self.cache.peek(filepath)
+        index = None
+        if entry is None or entry["signature"] != signature:
+            index = self._cached_tick_index(filepath, signature)
+        if index is None:
+            sorted_map = self._cached_load(filepath, "json")["__SortedMap__"]
+            return sorted(int(tick) for tick, history_at_tick in sorted_map.items() if "blocks" in history_at_tick.get("visibility", {}))
+
+        # the bytes of each tick are searched, not parsed
+        ticks = []
+        with open(filepath, "rb") as f:
+            for tick, (start, end) in zip(index["ticks"], index["spans"]):
+                f.seek(start)
+                if _has_block_visibility(f.read(end - start)):
+                    ticks.append(tick)
+        return ticks
+
+    def _cached_load_ticks(self, filepath):
+        """
+        Returns:
+            sorted ticks of a history file
+        """
+        stat = os.stat(filepath)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self.cache.peek(filepath)
+        if entry is None or entry["signature"] != signature:
+            index = self._cached_tick_index(filepath, signature)
+            if index is not None:
+                return index["ticks"]
+        return sorted(map(int, self._cached_load(filepath, "json")["__SortedMap__"].keys()))
+
+    def _cached_load_tick(self, filepath, tick):
+        """
+        Read a single tick of a history file. Unless the whole file is already
+        cached, only the bytes of that tick are read and parsed.
+
+        Returns:
+            history at tick, or None if the file has no such tick
+        """
+        stat = os.stat(filepath)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self.cache.peek(filepath)
+        if entry is None or entry["signature"] != signature:
+            index = self._cached_tick_index(filepath, signature)
+            if index is not None:
+                idx = bisect_left(index["ticks"], tick)
+                if idx == len(index["ticks"]) or index["ticks"][idx] != tick:
+                    return None
+
+                key = ("tick", filepath, tick)
+                entry = self._cached_get(key, signature)
+                if entry is None:
+                    start, end = index["spans"][idx]
+
+                    def load():
+                        with open(filepath, "rb") as f:
+                            f.seek(start)
+                            data = f.read(end - start)
+                        entry = {"obj": json_loads(data), "signature": signature}
+                        self.cache.put(key, entry, size=estimate_size(entry["obj"]))
+                        return entry
+                    entry = self._flights.do(key + (signature,), load)
+                return entry["obj"]
+
+        return self._cached_load(filepath, "json")["__SortedMap__"].get(str(tick))
     
-    def _cached_listdir(self, branch_ckpt_dir, valid_sec=2):
-        if branch_ckpt_dir in self.dir_cache:
-            now = time.perf_counter()
-            if now - self.dir_cache[branch_ckpt_dir]["time"] < valid_sec:
-                return self.dir_cache[branch_ckpt_dir]["files"]
+    def _cached_listdir(self, branch_ckpt_dir):
+        return self._cached_dir_entry(branch_ckpt_dir)["files"]
+
+    def _cached_dir_entry(self, dir_path):
+        # the watcher is not thread-safe, and listings are cheap enough to serialize
+        with self._dir_lock:
+            return self._cached_dir_entry_locked(dir_path)
+
+    def _cached_dir_entry_locked(self, dir_path):
+        entry = self.dir_cache.get(dir_path)
+        if entry is not None and self.dir_watcher.is_valid(dir_path):
+            return entry
         
-        files = os.listdir(branch_ckpt_dir)
-        self.dir_cache[branch_ckpt_dir] = {
-            "time": time.perf_counter(),
+        # start watching before listing so that no change is missed
+        self.dir_watcher.watch(dir_path)
+        files = os.listdir(dir_path)
+        names = frozenset(files)
+
+        # the index of observation files is updated with the changed names only
+        if entry is not None:
+            obs_files = _update_obs_file_index(entry["obs_files"], names - entry["names"], entry["names"] - names)
+        else:
+            obs_files = _update_obs_file_index({}, names, ())
+
+        entry = {
             "files": files,
+            "names": names,
+            "obs_files": obs_files,
         }
-        return files
+        self.dir_cache.put(dir_path, entry)
+        return entry
+
+    def _cached_obs_files(self, dir_path, type_, agent_name=None):
+        """
+        Returns:
+            ([tick, ...], [{"filename": ..., "tick": ...}, ...]) of the observation
+            files of `type_` (and `agent_name`) in dir_path, sorted by tick.
+            Both lists are shared and must not be modified.
+        """
+        return self._cached_dir_entry(dir_path)["obs_files"].get((type_, agent_name), ([], []))[:2]
     
-    def _cached_exists(self, path, valid_sec=2, check_if_false=False):
-        if path in self.cache:
-            return True
-        
-        if path in self.exist_cache:
-            now = time.perf_counter()
-            if now - self.exist_cache[path]["time"] < valid_sec:
-                exist = self.exist_cache[path]["exist"]
-                if not check_if_false or exist:
-                    return exist
-            
-        exist = Path(path).exists()
-        self.exist_cache[path] = {
-            "time": time.perf_counter(),
-            "exist": exist,
+    def get_obs_file_info(self, branch_ckpt_dir, type_, mode, agent_name=None, use_cache=True, tick=None):
+        """
+        Args:
+            mode: "list" for all files sorted by tick, "new"/"old" for the latest/oldest
+                file, or "find" for the file containing `tick`, i.e. the oldest file
+                whose tick is not less than `tick`
+        """
+        if use_cache:
+            ticks, result = self._cached_obs_files(branch_ckpt_dir, type_, agent_name)
+        else:
+            files = os.listdir(branch_ckpt_dir)
+            _, result, _ = _update_obs_file_index({}, files, ()).get((type_, agent_name), ([], [], []))
+            ticks = [file_info["tick"] for file_info in result]
+
+        if len(result) == 0 and mode != "list":
+            return {"filename": None, "tick": None}
+
+        if mode == "list":
+            return result  # [{'filename': ..., 'tick': ...}, ...]
+        elif mode == "new":
+            return result[-1] if result else None  # {'filename': ..., 'tick': ...}
+        elif mode == "old":
+            return result[0] if result else None  # {'filename': ..., 'tick': ...}
+        elif mode == "find":
+            idx = bisect_left(ticks, tick)
+            return result[idx] if idx < len(result) else {"filename": None, "tick": None}
+
+    def _cached_exists(self, path):
+        path = os.path.normpath(path)
+        root = os.path.normpath(self.ckpt_dir)
+        if not path.startswith(root + os.sep):
+            return os.path.exists(path)
+
+        # existence is answered from the (watched) listing of the parent directory
+        parent, name = os.path.split(path)
+        if not self._cached_exists(parent):
+            return False
+        return name in self._cached_dir_entry(parent)["names"]
+
+    def cache_stats(self):
+        return {
+            "file": dict(self.cache.stats(), invalidations=self.invalidations, coalesced=self._flights.coalesced),
+            "dir": dict(self.dir_cache.stats(), watch_mode=self.dir_watcher.mode),
+            "bitmap": _bitmap_cache.stats(),
+            "visibility": self.visibility_memo.stats(),
+            "ingest": {
+                "running": self._ingest_thread is not None,
+                "branches": len(self._tracked_branches),
+                "rounds": self.ingest_rounds,
+                "errors": self.ingest_errors,
+            },
         }
-        return exist
 
     def parse_source_str(self, branch_str):
         dirs = branch_str.split(".")
@@ -114,36 +453,90 @@ class ObservationLoader:
         internal_ckpt_dir = str(Path(base_ckpt_dir) / ".internal")
 
         if len(agent_list) == 1:
-            file_info = get_obs_file_info(internal_ckpt_dir, "state", "new", agent_name=agent_list[0])
+            file_info = self.get_obs_file_info(internal_ckpt_dir, "state", "new", agent_name=agent_list[0])
             state = self._cached_load(os.path.join(internal_ckpt_dir, file_info["filename"]), "json")
             return state, file_info["tick"]
         
+        # replays of the same chain are serialized, other chains run in parallel
+        agent_list_key = tuple(agent_list)
+        with self._chain_lock(agent_list_key):
+            return self._replay_internal_state(branch_str, base_ckpt_dir, agent_list)
+
+    def _replay_internal_state(self, branch_str, base_ckpt_dir, agent_list):
         # load history files
-        obj_history_files = get_obs_file_info(base_ckpt_dir, "history", "list")
+        obj_history_files = self.get_obs_file_info(base_ckpt_dir, "history", "list")
         
         # initialize state
         agent_list_key = tuple(agent_list)
-        if agent_list_key in self.statecache:
-            start_tick = sorted(self.statecache[agent_list_key].keys())[-1]
-            state = self.statecache[agent_list_key][start_tick]
+        with self._lock:
+            cached = self.statecache.get(agent_list_key)
+            if cached is not None:
+                start_tick = sorted(cached.keys())[-1]
+                cached = (cached[start_tick], self.statecache["OBJ"][start_tick])
+
+        if cached is not None:
+            state, obj_state = cached
 
             if obj_history_files[-1]["tick"] == start_tick:
                 return state, start_tick
             
-            state = copy.deepcopy(state)
-            obj_state = copy.deepcopy(self.statecache["OBJ"][start_tick])
+            # the new snapshot shares unchanged structures with the cached one
+            state = state.copy()
+            obj_state = obj_state.copy()
         else:
-            init_file_info = get_obs_file_info(internal_ckpt_dir, "state", "old", agent_name=agent_list[0])
-            state = self._cached_load(os.path.join(internal_ckpt_dir, init_file_info["filename"]), "json", deepcopy=True)
-            state["containers"] = {}
-            start_tick = init_file_info["tick"]
+            state, obj_state, start_tick = self._initial_internal_state(base_ckpt_dir, agent_list, obj_history_files[-1]["tick"])
+
+        tick = self._advance_internal_state(branch_str, base_ckpt_dir, agent_list, obj_history_files, state, obj_state, start_tick)
 
-            init_file_info = get_obs_file_info(base_ckpt_dir, "state", "old")
-            obj_state = self._cached_load(os.path.join(base_ckpt_dir, init_file_info["filename"]), "json", deepcopy=True)
+        # save cache. Only the latest snapshot of each chain is kept.
+        with self._lock:
+            self.statecache[agent_list_key] = {tick: state}
 
-        obj_block_state_map = Vec3Map(obj_state["blocks"])
+            self.statecache.setdefault("OBJ", {})
+            self.statecache["OBJ"][tick] = obj_state
+            live_ticks = {t for key, states in self.statecache.items() if key != "OBJ" for t in states}
+            for t in list(self.statecache["OBJ"].keys()):
+                if t not in live_ticks:
+                    del self.statecache["OBJ"][t]
+
+        return state, tick
+
+    def _initial_internal_state(self, base_ckpt_dir, agent_list, max_tick):
+        """
+        Returns:
+            (state, obj_state, tick) of the latest keyframe not after max_tick,
+            or of the initial state files
+        """
+        internal_ckpt_dir = str(Path(base_ckpt_dir) / ".internal")
+
+        keyframe = self._load_latest_keyframe(base_ckpt_dir, agent_list, max_tick)
+        if keyframe is not None:
+            for key in ["state", "objState"]:
+                # json turned the replayed ticks into strings
+                events = keyframe[key].get("events") or {}
+                keyframe[key]["events"] = {int(tick): events_at_tick for tick, events_at_tick in events.items()}
+            return BeliefState(keyframe["state"]), BeliefState(keyframe["objState"]), keyframe["tick"]
+
+        init_file_info = self.get_obs_file_info(internal_ckpt_dir, "state", "old", agent_name=agent_list[0])
+        state = BeliefState(self._cached_load(os.path.join(internal_ckpt_dir, init_file_info["filename"]), "json"))
+        state.containers = Vec3Map()
+        start_tick = init_file_info["tick"]
+
+        init_file_info = self.get_obs_file_info(base_ckpt_dir, "state", "old")
+        obj_state = BeliefState(self._cached_load(os.path.join(base_ckpt_dir, init_file_info["filename"]), "json"))
+        return state, obj_state, start_tick
+
+    def _advance_internal_state(self, branch_str, base_ckpt_dir, agent_list, obj_history_files, state, obj_state, start_tick, end_tick=None):
+        """
+        Replay the ticks in (start_tick, end_tick] onto state and obj_state in place.
+
+        Returns:
+            the last replayed tick, or start_tick if there was none
+        """
+        obj_block_state_map = obj_state.blocks
 
         tick = start_tick
+        keyframe_tick = max(start_tick, 0)
         for obj_history_file in obj_history_files:
             obj_filename = obj_history_file["filename"]
             obj_file_tick = obj_history_file["tick"]
@@ -153,36 +546,130 @@ class ObservationLoader:
             obj_history = self._cached_load(str(Path(base_ckpt_dir).joinpath(obj_filename)), "json")
             
             for key in obj_history["__SortedMap__"]:
-                tick = int(key)
-                if tick <= start_tick:
+                if int(key) <= start_tick:
                     continue
+                if end_tick is not None and int(key) > end_tick:
+                    return tick
+                tick = int(key)
 
                 for e in obj_history["__SortedMap__"][key]["events"]:
                     if e["eventName"] == "blockUpdate":
-                        obj_block_state_map.set(e["blockPos"], copy.deepcopy(e["visible"]))
+                        obj_block_state_map.set(_unwrap_vec3(e["blockPos"]), copy.deepcopy(e["visible"]))
 
                 filtered_history, _ = self._get_internal_history(branch_str, base_ckpt_dir, agent_list, tick)
 
-                block_vis = filtered_history["visibility"]["blocks"]
-                block_visibility_from_agent = Vec3BoolMap(
-                    (np.array(block_vis["__Vec3BoolMap__"]["range"][0]["__Vec3__"]),
-                    np.array(block_vis["__Vec3BoolMap__"]["range"][1]["__Vec3__"]))
-                )
-                block_visibility_from_agent.from_base64(block_vis["__Vec3BoolMap__"]["base64"])
-
                 update_state(tick, state, filtered_history, obj_block_state_map, agent_list)
 
-        obj_state["blocks"] = obj_block_state_map.to_dict()
+                if self.keyframe_interval and tick // self.keyframe_interval > keyframe_tick // self.keyframe_interval:
+                    self._save_keyframe(base_ckpt_dir, agent_list, tick, state, obj_state)
+                    keyframe_tick = tick
 
-        # save cache
-        self.statecache.setdefault(tuple(agent_list), {})
-        self.statecache[tuple(agent_list)][tick] = state
+        return tick
 
-        self.statecache.setdefault("OBJ", {})
-        self.statecache["OBJ"][tick] = obj_state
+    def _replay_internal_state_at(self, branch_str, base_ckpt_dir, agent_list, tick):
+        obj_history_files = self.get_obs_file_info(base_ckpt_dir, "history", "list")
+        if tick >= obj_history_files[-1]["tick"]:
+            return self._replay_internal_state(branch_str, base_ckpt_dir, agent_list)
 
+        # start from the latest state not after tick among the latest state of
+        # the chain, the results of earlier calls and the keyframes
+        agent_list_key = tuple(agent_list)
+        candidates = []
+        with self._lock:
+            cached = self.statecache.get(agent_list_key)
+            if cached is not None:
+                cached_tick = sorted(cached.keys())[-1]
+                if cached_tick <= tick:
+                    candidates.append((cached_tick, cached[cached_tick], self.statecache["OBJ"][cached_tick]))
+        for key in self.state_snapshots.keys():
+            if key[:2] == (base_ckpt_dir, agent_list_key) and key[2] <= tick:
+                snapshot = self.state_snapshots.peek(key)
+                if snapshot is not None:
+                    candidates.append((key[2],) + snapshot)
+
+        start = max(candidates, key=lambda x: x[0], default=None)
+        if start is None or (self.keyframe_interval and tick - start[0] >= self.keyframe_interval):
+            state, obj_state, start_tick = self._initial_internal_state(base_ckpt_dir, agent_list, tick)
+            if start is not None and start[0] >= start_tick:
+                start_tick, state, obj_state = start
+                state, obj_state = state.copy(), obj_state.copy()
+            elif start_tick > tick:
+                raise Exception(f"No state data found at or before tick '{tick}'.")
+        else:
+            start_tick, state, obj_state = start
+            # the new snapshot shares unchanged structures with the cached one
+            state, obj_state = state.copy(), obj_state.copy()
+
+        tick = self._advance_internal_state(branch_str, base_ckpt_dir, agent_list, obj_history_files, state, obj_state, start_tick, end_tick=tick)
+        self.state_snapshots.put((base_ckpt_dir, agent_list_key, tick), (state, obj_state))
         return state, tick
     
+    def _keyframe_sources(self, base_ckpt_dir, agent_list, tick):
+        """
+        Files a derived state at `tick` is computed from, with their (size, mtime).
+        """
+        internal_ckpt_dir = os.path.join(base_ckpt_dir, ".internal")
+
+        filepaths = [
+            os.path.join(base_ckpt_dir, self.get_obs_file_info(base_ckpt_dir, "state", "old")["filename"]),
+            os.path.join(internal_ckpt_dir, self.get_obs_file_info(internal_ckpt_dir, "state", "old", agent_name=agent_list[0])["filename"]),
+        ]
+        for dir_, agent_name in [(base_ckpt_dir, None)] + [(internal_ckpt_dir, a) for a in agent_list]:
+            file_info_list = self.get_obs_file_info(dir_, "history", "list", agent_name=agent_name)
+            # history files up to (and including) the one containing `tick`
+            idx = bisect_left([file_info["tick"] for file_info in file_info_list], tick)
+            for file_info in file_info_list[:idx + 1]:
+                filepaths.append(os.path.join(dir_, file_info["filename"]))
+
+        sources = {}
+        for filepath in filepaths:
+            stat = os.stat(filepath)
+            sources[os.path.relpath(filepath, base_ckpt_dir)] = [stat.st_size, stat.st_mtime_ns]
+        return sources
+
+    def _save_keyframe(self, base_ckpt_dir, agent_list, tick, state, obj_state):
+        keyframe_dir = os.path.join(base_ckpt_dir, ".internal", ".keyframes")
+        filepath = os.path.join(keyframe_dir, f'{"-".join(agent_list)}#keyframe#{tick}.json')
+        keyframe = {
+            "tick": tick,
+            "agentList": agent_list,
+            "sources": self._keyframe_sources(base_ckpt_dir, agent_list, tick),
+            "state": state.to_dict(),
+            "objState": obj_state.to_dict(),
+        }
+        try:
+            os.makedirs(keyframe_dir, exist_ok=True)
+            tmp_filepath = filepath + ".tmp"
+            with open(tmp_filepath, "w", encoding="utf-8") as f:
+                f.write(json_dumps(keyframe, ensure_ascii=False))
+            os.replace(tmp_filepath, filepath)
+        except OSError as e:
+            warnings.warn(f"Failed to save keyframe ({e}). Saving keyframes is disabled.")
+            self.keyframe_interval = None
+
+    def _load_latest_keyframe(self, base_ckpt_dir, agent_list, max_tick):
+        keyframe_dir = os.path.join(base_ckpt_dir, ".internal", ".keyframes")
+        if not self._cached_exists(keyframe_dir):
+            return None
+
+        file_info_list = self.get_obs_file_info(keyframe_dir, "keyframe", "list", agent_name="-".join(agent_list))
+        for file_info in reversed(file_info_list):
+            if file_info["tick"] > max_tick:
+                continue
+            try:
+                with open(os.path.join(keyframe_dir, file_info["filename"]), "rb") as f:
+                    keyframe = json_loads(f.read())
+                # stale if any history file it was derived from has been rewritten
+                if keyframe["agentList"] != agent_list:
+                    continue
+                if keyframe["sources"] != self._keyframe_sources(base_ckpt_dir, agent_list, keyframe["tick"]):
+                    continue
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            return keyframe
+
+        return None
+    
     def _get_internal_latest_history(self, branch_str, base_ckpt_dir, agent_list):
         return self._get_internal_history(branch_str, base_ckpt_dir, agent_list, tick=None)
     
@@ -190,87 +677,126 @@ class ObservationLoader:
         assert len(agent_list) >=1
         internal_ckpt_dir = str(Path(base_ckpt_dir) / ".internal")
 
-        file_info_list = get_obs_file_info(internal_ckpt_dir, "history", "list", agent_name=agent_list[0])
-        if not len(file_info_list):
-            return None, tick
-
         if tick is None:
-            file_info = file_info_list[-1]
-            history = self._cached_load(os.path.join(internal_ckpt_dir, file_info["filename"]), "json")
-            sorted_ticks = sorted(map(int, history["__SortedMap__"].keys()))
-            tick = sorted_ticks[-1]
+            file_info = self.get_obs_file_info(internal_ckpt_dir, "history", "new", agent_name=agent_list[0])
+            if file_info["filename"] is None:
+                return None, tick
+            filepath = os.path.join(internal_ckpt_dir, file_info["filename"])
+            tick = self._cached_load_ticks(filepath)[-1]
         else:
-            ticks = list(map(lambda file_info: file_info["tick"], file_info_list))
-            idx = bisect_left(ticks, tick)
-
-            file_info = file_info_list[idx]
-            # Read and parse history file
-            history = self._cached_load(os.path.join(internal_ckpt_dir, file_info["filename"]), "json")
-            
-            if str(tick) not in history["__SortedMap__"]:
+            file_info = self.get_obs_file_info(internal_ckpt_dir, "history", "find", agent_name=agent_list[0], tick=tick)
+            if file_info["filename"] is None:
                 return None, tick
+            filepath = os.path.join(internal_ckpt_dir, file_info["filename"])
         
-        history_at_tick = history["__SortedMap__"][str(tick)]
+        # Read and parse the tick of the history file
+        history_at_tick = self._cached_load_tick(filepath, tick)
+        if history_at_tick is None:
+            return None, tick
         assert "visibility" in history_at_tick, f"Error tick={tick}, keys()={list(history_at_tick.keys())}, status={history_at_tick['status']}"
 
         if len(agent_list) == 1:
             return history_at_tick, tick
-        
-        def history2blockvis(history_at_tick, tick, agent_name):
-            assert "visibility" in history_at_tick, f"Error agent_name={agent_name}, tick={tick}, keys()={list(history_at_tick.keys())}, agent_list={agent_list}, status={history_at_tick['status']}"
-            if "blocks" not in history_at_tick["visibility"]:
-                history_at_tick, _ = self.get_previous_block_vis(branch_str, tick)
-
-            tmp = history_at_tick["visibility"]["blocks"]["__Vec3BoolMap__"]
-            block_vis = Vec3BoolMap(
-                (tmp["range"][0]["__Vec3__"], 
-                tmp["range"][1]["__Vec3__"])
-            )
-            block_vis.from_base64(tmp["base64"])
-            return block_vis
-        
-        player_vis = history_at_tick["visibility"]["players"]
-        player_vis[agent_list[0]] = True
-        block_vis = history2blockvis(history_at_tick, tick, agent_list[0])
-        for see_agent in agent_list[1:]:
-            see_agent_history_at_tick, _ = self._get_internal_history(branch_str, base_ckpt_dir, [see_agent], tick=tick)
-            see_agent_block_vis = history2blockvis(see_agent_history_at_tick, tick, see_agent)
-
-            block_vis = block_vis.intersection(see_agent_block_vis)
-
-            see_agent_player_vis = see_agent_history_at_tick["visibility"]["players"]
-            see_agent_player_vis[see_agent] = True
-            for agent in player_vis:
-                if not player_vis[agent] or not see_agent_player_vis[agent]:
-                    player_vis[agent] = False
-
-        status = filter_status(history_at_tick["status"], see_agent, player_vis)
-        events = filter_events(history_at_tick["events"], see_agent, player_vis, block_vis)
-        history_at_tick = { 
-            "status": status,
-            "events": events,
-            "visibility": {
-                "players": player_vis,
-                "blocks": {
-                    "__Vec3BoolMap__": {
-                        "range": [
-                            {"__Vec3__": list(block_vis.range[0])},
-                            {"__Vec3__": list(block_vis.range[1])},
-                        ],
-                        "base64": block_vis.to_base64()
-                    }
+
+        return self._get_visibility(branch_str, base_ckpt_dir, agent_list, tick)["history"], tick
+
+    def _get_visibility(self, branch_str, base_ckpt_dir, agent_list, tick):
+        """
+        Visibility along the chain agent_list at tick, i.e. what agent_list[0]
+        believes that ... agent_list[-1] sees. Memoized per (chain, tick) in
+        decoded form; a chain is computed from the visibility of its prefix,
+        so each additional agent costs a single intersection.
+
+        Returns:
+            {"players": dict, "blocks": Vec3BoolMap,
+             "history": history of agent_list[0] filtered by the visibility (None for a single agent)}
+        """
+        see_agent = agent_list[-1]
+        prefix = self._get_visibility(branch_str, base_ckpt_dir, agent_list[:-1], tick) if len(agent_list) > 1 else None
+
+        # entries hold the signature of the history file and the serial of the
+        # prefix entry rather than the objects, so they only keep their own data alive
+        source = self._internal_history_signature(base_ckpt_dir, see_agent, tick)
+        prefix_serial = None if prefix is None else prefix["serial"]
+        key = (base_ckpt_dir, tuple(agent_list), tick)
+        memo = self.visibility_memo.get(key)
+        if memo is not None and source is not None and memo["source"] == source and memo["prefix"] == prefix_serial:
+            return memo
+
+        see_agent_history_at_tick, _ = self._get_internal_history(branch_str, base_ckpt_dir, [see_agent], tick=tick)
+        assert "visibility" in see_agent_history_at_tick, f"Error agent_name={see_agent}, tick={tick}, keys()={list(see_agent_history_at_tick.keys())}, agent_list={agent_list}, status={see_agent_history_at_tick['status']}"
+
+        # copied, as the loaded history is cached
+        player_vis = dict(see_agent_history_at_tick["visibility"]["players"])
+        player_vis[see_agent] = True
+        if prefix is not None:
+            player_vis = {
+                agent: False if not visible or not player_vis[agent] else visible
+                for agent, visible in prefix["players"].items()
+            }
+
+        if "blocks" in see_agent_history_at_tick["visibility"]:
+            block_vis = Vec3BoolMap.from_json(see_agent_history_at_tick["visibility"]["blocks"])
+            if prefix is not None:
+                block_vis = prefix["blocks"].intersection(block_vis)
+        else:
+            internal_ckpt_dir = str(Path(base_ckpt_dir) / ".internal")
+            file_info_list = self.get_obs_file_info(internal_ckpt_dir, "history", "list", agent_name=agent_list[0])
+            previous = self._find_previous_block_vis(internal_ckpt_dir, file_info_list, tick)
+            if previous is None:
+                raise Exception(f'Failed to get history of block visibility of "{agent_list[0]}" before tick "{tick}".')
+            block_vis = self._get_visibility(branch_str, base_ckpt_dir, agent_list, previous[1])["blocks"]
+
+        filtered_history = None
+        if prefix is not None:
+            history_at_tick, _ = self._get_internal_history(branch_str, base_ckpt_dir, agent_list[:1], tick=tick)
+            status = filter_status(history_at_tick["status"], see_agent, player_vis)
+            events = filter_events(history_at_tick["events"], see_agent, player_vis, block_vis)
+            filtered_history = {
+                "status": status,
+                "events": events,
+                "visibility": {
+                    "players": player_vis,
+                    "blocks": block_vis.to_json(),
                 },
-            },
-        }
+            }
 
-        return history_at_tick, tick
+        memo = {
+            "source": source,
+            "prefix": prefix_serial,
+            "serial": next(self._visibility_serials),
+            "players": player_vis,
+            "blocks": block_vis,
+            "history": filtered_history,
+        }
+        size = block_vis.data.nbytes + estimate_size(player_vis) + estimate_size(filtered_history)
+        self.visibility_memo.put(key, memo, size=size)
+        return memo
+
+    def _internal_history_signature(self, base_ckpt_dir, agent_name, tick):
+        """
+        Returns:
+            (filepath, mtime, size) of the internal history file of agent_name
+            containing tick, or None if there is none
+        """
+        internal_ckpt_dir = str(Path(base_ckpt_dir) / ".internal")
+        file_info = self.get_obs_file_info(internal_ckpt_dir, "history", "find", agent_name=agent_name, tick=tick)
+        if file_info["filename"] is None:
+            return None
+        filepath = os.path.join(internal_ckpt_dir, file_info["filename"])
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+        return (filepath, stat.st_mtime_ns, stat.st_size)
 
 
     def get_latest_state(self, branch_str):
+        self._track_branch(branch_str)
         branch_ckpt_dir = self.parse_source_str(branch_str)
 
         if self._cached_exists(branch_ckpt_dir):
-            file_info = get_obs_file_info(branch_ckpt_dir, "state", "new")
+            file_info = self.get_obs_file_info(branch_ckpt_dir, "state", "new")
             if not file_info["filename"]:
                 raise Exception(f"No state data found.")
 
@@ -288,31 +814,141 @@ class ObservationLoader:
     def get_state(self, branch_str, tick):
         branch_ckpt_dir = self.parse_source_str(branch_str)
 
-        file_info_list = get_obs_file_info(branch_ckpt_dir, "state", "list")
+        file_info_list = self.get_obs_file_info(branch_ckpt_dir, "state", "list")
         if not len(file_info_list):
             raise Exception(f"No state data found.")
         
-        for file_info in file_info_list:
-            if file_info["tick"] == tick:
-                # Read and parse state file
-                state = self._cached_load(os.path.join(branch_ckpt_dir, file_info["filename"]), "yaml")
-                return state, tick
+        file_info = self.get_obs_file_info(branch_ckpt_dir, "state", "find", tick=tick)
+        if file_info["tick"] == tick:
+            # Read and parse state file
+            state = self._cached_load(os.path.join(branch_ckpt_dir, file_info["filename"]), "json")
+            return state, tick
                 
         raise Exception(f"No state data found at tick '{tick}'.")
 
+    def get_state_at(self, branch_str, tick):
+        """
+        State of any branch as of `tick`. For branches with state files (branches
+        on disk and follow branches of a single agent), this is the latest state
+        file not after `tick`. Other follow branches are replayed up to `tick`,
+        starting from the nearest keyframe or earlier result, so that sampling
+        many ticks in increasing order replays each tick once.
+
+        Returns:
+            (state, t): t is the tick of the state, not after `tick`
+        """
+        branch_ckpt_dir = self.parse_source_str(branch_str)
+        if self._cached_exists(branch_ckpt_dir):
+            return self._get_state_file_at(branch_ckpt_dir, None, tick)
+
+        base_ckpt_dir, agent_list = self.find_base_ckpt_dir(branch_str)
+        if len(agent_list) == 1:
+            return self._get_state_file_at(str(Path(base_ckpt_dir) / ".internal"), agent_list[0], tick)
+
+        with self._chain_lock(tuple(agent_list)):
+            return self._replay_internal_state_at(branch_str, base_ckpt_dir, agent_list, tick)
+
+    def _get_state_file_at(self, dir_path, agent_name, tick):
+        ticks, file_info_list = self._cached_obs_files(dir_path, "state", agent_name)
+        idx = bisect_right(ticks, tick) - 1
+        if idx < 0:
+            raise Exception(f"No state data found at or before tick '{tick}'.")
+        file_info = file_info_list[idx]
+        state = self._cached_load(os.path.join(dir_path, file_info["filename"]), "json")
+        return state, file_info["tick"]
+
+    def diff_states(self, branch_str, tick, other_branch_str, other_tick):
+        """
+        Differences between the states of two (branch, tick) pairs, e.g. the
+        world and an agent's belief. Blocks and containers are compared as
+        palette ids, without building per-block dicts.
+
+        Args:
+            tick, other_tick: see get_state_at. None for the latest state.
+
+        Returns:
+            {
+                "ticks": [tick of the state, tick of the other state],
+                "blocks": [{"position": [x, y, z], "a": value or None, "b": value or None}, ...],
+                "containers": same as "blocks",
+                "inventories": {agent_name: {"a": inventory, "b": inventory}, ...},
+                "positions": {agent_name: {"a": [x, y, z], "b": [x, y, z]}, ...},
+            }
+            where "a" is the value in the state and "b" in the other state.
+            Only differing entries are listed, and missing values are None.
+        """
+        states = []
+        for b, t in [(branch_str, tick), (other_branch_str, other_tick)]:
+            states.append(self.get_latest_state(b) if t is None else self.get_state_at(b, t))
+        (state, t), (other_state, other_t) = states
+
+        result = {"ticks": [t, other_t]}
+        for key in ["blocks", "containers"]:
+            vec3map, other_vec3map = self._state_vec3map(state, key), self._state_vec3map(other_state, key)
+            positions, ids, other_ids = vec3map.diff(other_vec3map)
+            values, other_values = vec3map.values, other_vec3map.values
+            result[key] = [
+                {
+                    "position": position,
+                    "a": values[value_id] if value_id >= 0 else None,
+                    "b": other_values[other_value_id] if other_value_id >= 0 else None,
+                }
+                for position, value_id, other_value_id in zip(positions.tolist(), ids.tolist(), other_ids.tolist())
+            ]
+
+        status, other_status = state["status"], other_state["status"]
+        for key, get in [("inventories", _status_inventory), ("positions", _status_position)]:
+            result[key] = {}
+            for agent_name in list(status) + [a for a in other_status if a not in status]:
+                value, other_value = get(status.get(agent_name)), get(other_status.get(agent_name))
+                if value != other_value:
+                    result[key][agent_name] = {"a": value, "b": other_value}
+        return result
+
+    def _state_vec3map(self, state, key):
+        if isinstance(state, BeliefState):
+            return getattr(state, key)
+
+        # states of files are cached, so is their decoded form
+        source = state.get(key) or {}
+        entry = self.vec3map_memo.get(id(source))
+        if entry is not None and entry[0] is source:
+            return entry[1]
+        vec3map = Vec3Map(source)
+        vec3map._materialize()
+        self.vec3map_memo.put(id(source), (source, vec3map), size=vec3map._ids.nbytes + vec3map._seq.nbytes)
+        return vec3map
+
+    def _state_event_index(self, state):
+        """
+        Returns:
+            (_EventIndex, number of ticks of the state) of the events of `state`
+        """
+        if isinstance(state, BeliefState):
+            return state.events.index()
+
+        # states of files are cached, so is the index of their events
+        source = state.get("events") or {}
+        entry = self.event_index_memo.get(id(source))
+        if entry is not None and entry[0] is source:
+            return entry[1], len(source)
+        index = _EventIndex()
+        index.extend(list(source.items()))
+        self.event_index_memo.put(id(source), (source, index))
+        return index, len(source)
+
     def get_latest_history(self, branch_str):
         branch_ckpt_dir = self.parse_source_str(branch_str)
         
         if self._cached_exists(branch_ckpt_dir):
-            file_info = get_obs_file_info(branch_ckpt_dir, "history", "new")
+            file_info = self.get_obs_file_info(branch_ckpt_dir, "history", "new")
             if not file_info["filename"]:
                 raise Exception(f"No history data found. Observation must be performed to load it.")
 
-            # Read and parse history file
-            history = self._cached_load(os.path.join(branch_ckpt_dir, file_info["filename"]), "json")
-
-            latest_key = sorted(map(int, history["__SortedMap__"].keys()))[-1]
-            latest_history = history["__SortedMap__"][str(latest_key)]
+            # Read and parse the latest tick of the history file
+            filepath = os.path.join(branch_ckpt_dir, file_info["filename"])
+            latest_key = self._cached_load_ticks(filepath)[-1]
+            latest_history = self._cached_load_tick(filepath, latest_key)
 
             return latest_history, latest_key
         
@@ -325,20 +961,13 @@ class ObservationLoader:
         branch_ckpt_dir = self.parse_source_str(branch_str)
 
         if self._cached_exists(branch_ckpt_dir):
-            file_info_list = get_obs_file_info(branch_ckpt_dir, "history", "list")
-            if not len(file_info_list):
+            file_info = self.get_obs_file_info(branch_ckpt_dir, "history", "find", tick=tick)
+            if file_info["filename"] is None:
                 return None, tick
 
-            ticks = list(map(lambda file_info: file_info["tick"], file_info_list))
-            idx = bisect_left(ticks, tick)
-
-            file_info = file_info_list[idx]
-            # Read and parse history file
-            history = self._cached_load(os.path.join(branch_ckpt_dir, file_info["filename"]), "json")
-            if str(tick) in history["__SortedMap__"]:
-                return history["__SortedMap__"][str(tick)], tick
-                    
-            return None, tick
+            # Read and parse the tick of the history file
+            history_at_tick = self._cached_load_tick(os.path.join(branch_ckpt_dir, file_info["filename"]), tick)
+            return history_at_tick, tick
         
         else:
             base_ckpt_dir, agent_list = self.find_base_ckpt_dir(branch_str)
@@ -349,55 +978,124 @@ class ObservationLoader:
         branch_ckpt_dir = self.parse_source_str(branch_str)
 
         if self._cached_exists(branch_ckpt_dir):
-            file_info_list = get_obs_file_info(branch_ckpt_dir, "history", "list")
+            file_info_list = self.get_obs_file_info(branch_ckpt_dir, "history", "list")
             internal = False
         else:
             base_ckpt_dir, agent_list = self.find_base_ckpt_dir(branch_str)
             branch_ckpt_dir = str(Path(base_ckpt_dir).joinpath(".internal"))
-            file_info_list = get_obs_file_info(branch_ckpt_dir, "history", "list", agent_name=agent_list[0])
+            file_info_list = self.get_obs_file_info(branch_ckpt_dir, "history", "list", agent_name=agent_list[0])
             internal = True
 
         if not len(file_info_list):
             raise Exception(f"No history data found. Observation must be performed to load it.")
-        
-        def get_last_min_index(f_idx, tick):
-            file_info = file_info_list[f_idx]
-            # Read and parse history file
-            history = self._cached_load(os.path.join(branch_ckpt_dir, file_info["filename"]), "json")
-
-            f_ticks = sorted(map(int, history["__SortedMap__"].keys()))
-            # Find the last index where value < now_tick
-            idx = bisect_left(f_ticks, tick) - 1
-            if idx < 0:
-                return None, None
-
-            tick = f_ticks[idx]
-            return history, tick
-        
-        ticks = list(map(lambda file_info: file_info["tick"], file_info_list))
-        tick = now_tick
-        file_idx = bisect_left(ticks, tick - 1)
-        while True:
-            tmp_history, tmp_tick = get_last_min_index(file_idx, tick)
-            if tmp_history is None:  # if now_tick is the first tick of selected history file
-                if file_idx == 0:  # if there is no previous history file
-                    return None
-                file_idx -= 1
-                history, tick = get_last_min_index(file_idx, tick)  # search from previous history file
-                assert history is not None
 
-            else:
-                history, tick = tmp_history, tmp_tick
-
-            history_at_tick = history["__SortedMap__"][str(tick)]
-            if "blocks" in history_at_tick.get("visibility", {}):
-                break
+        previous = self._find_previous_block_vis(branch_ckpt_dir, file_info_list, now_tick)
+        if previous is None:
+            return None
+        history_at_tick, tick = previous
 
         if internal:
             history_at_tick, _ = self._get_internal_history(branch_str, base_ckpt_dir, agent_list, tick)
         
         return history_at_tick, tick   
 
+    def _find_previous_block_vis(self, branch_ckpt_dir, file_info_list, now_tick):
+        """
+        Returns:
+            (history_at_tick, tick) of the last tick before now_tick with block
+            visibility, or None
+        """
+        ticks = [file_info["tick"] for file_info in file_info_list]
+        # the file holding now_tick - 1, then earlier files if it has no block visibility before now_tick
+        file_idx = min(bisect_left(ticks, now_tick - 1), len(ticks) - 1)
+        for f_idx in range(file_idx, -1, -1):
+            filepath = os.path.join(branch_ckpt_dir, file_info_list[f_idx]["filename"])
+            vis_ticks = self._cached_block_vis_ticks(filepath)
+            idx = bisect_left(vis_ticks, now_tick) - 1
+            if idx >= 0:
+                tick = vis_ticks[idx]
+                return self._cached_load_tick(filepath, tick), tick
+
+        return None
+
+_SORTED_MAP_HEADER = b'{\n\t"__SortedMap__": {'
+_VISIBILITY_KEY = b'\n\t\t\t"visibility": {'
+_VISIBILITY_END = b'\n\t\t\t}'
+_BLOCK_VISIBILITY_KEY = b'\n\t\t\t\t"blocks": '
+_TICK_KEY_REGEX = re.compile(rb'\n\t\t"(-?\d+)": ')
+_TICK_KEY_MAX_LEN = 64
+
+
+def _scan_sorted_map(f, chunk_size=1024 ** 2):
+    """
+    Scan a tab-indented `{"__SortedMap__": {...}}` json (as written by the
+    mineflayer server) for the byte spans of the values of its keys, without
+    parsing them.
+
+    Returns:
+        {"ticks": [tick, ...], "spans": [(start, end), ...]} sorted by tick, or
+        None if the file is not in this format
+    """
+    if f.read(len(_SORTED_MAP_HEADER)) != _SORTED_MAP_HEADER:
+        return None
+
+    keys = []  # (tick, key offset, value offset)
+    buf = b""
+    buf_offset = len(_SORTED_MAP_HEADER)
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        # a key may be cut at the end of the buffer unless the file has been read through
+        limit = len(buf) - _TICK_KEY_MAX_LEN if chunk else len(buf)
+        for match in _TICK_KEY_REGEX.finditer(buf, 0, max(limit, 0)):
+            if not keys or buf_offset + match.start() > keys[-1][1]:
+                keys.append((int(match.group(1)), buf_offset + match.start(), buf_offset + match.end()))
+        if not chunk:
+            break
+        keep = max(limit - _TICK_KEY_MAX_LEN, 0)
+        buf = buf[keep:]
+        buf_offset += keep
+
+    # values end before the "," in front of the next key, or before the closing
+    # braces of the SortedMap and of the root object
+    tail = buf.rstrip()
+    for _ in range(2):
+        if not tail.endswith(b"}"):
+            return None
+        tail = tail[:-1].rstrip()
+    last_end = buf_offset + len(tail)
+
+    entries = []
+    for i, (tick, _, start) in enumerate(keys):
+        end = keys[i + 1][1] - 1 if i + 1 < len(keys) else last_end
+        entries.append((tick, (start, end)))
+    entries.sort(key=lambda x: x[0])
+    return {
+        "ticks": [tick for tick, _ in entries],
+        "spans": [span for _, span in entries],
+    }
+
+
+def _has_block_visibility(data):
+    """
+    Whether the bytes of one tick of a tab-indented history file, as spanned
+    by _scan_sorted_map, have `visibility.blocks`.
+    """
+    start = data.find(_VISIBILITY_KEY)
+    if start < 0:
+        return False
+    end = data.find(_VISIBILITY_END, start)
+    return data.find(_BLOCK_VISIBILITY_KEY, start, len(data) if end < 0 else end) >= 0
+
+
+_bitmap_cache = LRUCache(max_bytes=256 * 1024**2)
+
+
+def _cache_bitmap(key, data):
+    data.flags.writeable = False
+    _bitmap_cache.put(key, data, size=data.nbytes + len(key[1]))
+
+
 class Vec3BoolMap:
     def __init__(self, range_):
         self.range = (np.array(range_[0]), np.array(range_[1]))
@@ -420,10 +1118,9 @@ class Vec3BoolMap:
         return np.array([x, y, z]) + self.range[0]
 
     def from_base64(self, base64_str: str):
-        byte_array = base64.b64decode(base64_str)
-        binary_str = ''.join(f'{byte:08b}' for byte in byte_array)
-        total_size = int(np.prod(self.size))
-        self.data = np.array([bit == '1' for bit in binary_str[:total_size]], dtype=bool)
+        byte_array = np.frombuffer(base64.b64decode(base64_str), dtype=np.uint8)
+        total_size = min(int(np.prod(self.size)), len(byte_array) * 8)
+        self.data = np.unpackbits(byte_array, count=total_size, bitorder='big').view(bool)
 
     def to_base64(self) -> str:
         bits = self.data.astype(np.uint8)
@@ -434,12 +1131,45 @@ class Vec3BoolMap:
         byte_arr = np.packbits(bits, bitorder='big')
         return base64.b64encode(byte_arr.tobytes()).decode('ascii')        
 
+    @classmethod
+    def from_json(cls, vec3boolmap):
+        """
+        Decode `{"__Vec3BoolMap__": {"range": ..., "base64": ...}}`. Decoded
+        bitmaps are cached by content and shared, so `data` is read-only.
+        """
+        vec3boolmap = vec3boolmap.get("__Vec3BoolMap__", vec3boolmap)
+        range_ = (tuple(vec3boolmap["range"][0]["__Vec3__"]), tuple(vec3boolmap["range"][1]["__Vec3__"]))
+        key = (range_, vec3boolmap["base64"])
+
+        result = cls(range_)
+        data = _bitmap_cache.get(key)
+        if data is None:
+            result.from_base64(key[1])
+            _cache_bitmap(key, result.data)
+        else:
+            result.data = data
+        return result
+
+    def to_json(self):
+        range_ = (tuple(self.range[0].tolist()), tuple(self.range[1].tolist()))
+        base64_str = self.to_base64()
+        # the encoded bitmap is typically decoded again soon
+        _cache_bitmap((range_, base64_str), self.data)
+        return {
+            "__Vec3BoolMap__": {
+                "range": [{"__Vec3__": list(range_[0])}, {"__Vec3__": list(range_[1])}],
+                "base64": base64_str,
+            }
+        }
+
     def add(self, vec) -> None:
         v = np.asarray(vec, dtype=int)
         if v.shape != (3,):
             raise ValueError("vec must be length-3 (x, y, z).")
         if not self._is_within_range(v):
             raise ValueError("Vec3 is out of the specified range.")
+        if not self.data.flags.writeable:
+            self.data = self.data.copy()
         idx = self._to_index(v)
         self.data[idx] = True
 
@@ -447,10 +1177,38 @@ class Vec3BoolMap:
         if not self._is_within_range(vec):
             return False
         return bool(self.data[self._to_index(vec)])
+
+    def has_array(self, positions) -> np.ndarray:
+        """
+        Args:
+            positions: (N, 3) int array
+
+        Returns:
+            (N,) bool array, False outside the range
+        """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        rel = positions - self.range[0]
+        inside = np.all((rel >= 0) & (rel < self.size), axis=1)
+        rel = rel[inside]
+        result = np.zeros(len(positions), dtype=bool)
+        result[inside] = self.data[rel[:, 0] + self.size[0] * (rel[:, 1] + self.size[1] * rel[:, 2])]
+        return result
     
     def get_all(self):
-        true_indices = np.flatnonzero(self.data)
-        return [self._from_index(int(i)) for i in true_indices]
+        return list(self.get_all_array())
+
+    def get_all_array(self) -> np.ndarray:
+        """
+        Returns:
+            (N, 3) int array of the positions set to True, in index order
+        """
+        indices = np.flatnonzero(self.data)
+        sx, sy = int(self.size[0]), int(self.size[1])
+        positions = np.empty((len(indices), 3), dtype=np.int64)
+        positions[:, 0] = indices % sx
+        positions[:, 1] = (indices // sx) % sy
+        positions[:, 2] = indices // (sx * sy)
+        return positions + self.range[0].astype(np.int64)
     
     def intersection(self, other):
         if not isinstance(other, Vec3BoolMap):
@@ -492,92 +1250,841 @@ class Vec3BoolMap:
 
         return result
 
-def _vec2key_array(positions):
-    """positions: (N,3) ndarray"""
-    n = positions.shape[0]
-    out = np.empty((n, 3), np.int64)
-    for i in range(n):
-        out[i, 0] = int(positions[i, 0])
-        out[i, 1] = int(positions[i, 1])
-        out[i, 2] = int(positions[i, 2])
-    return out
+def _unwrap_vec3(vec):
+    if isinstance(vec, dict):
+        return vec["__Vec3__"]
+    return vec
+
+
+def _palette_key(value):
+    # block states are mostly {"name": ...}, which need no json encoding
+    if type(value) is str:
+        return (value,)
+    if type(value) is dict and len(value) == 1:
+        for k, v in value.items():
+            if type(v) is str:
+                return (k, v)
+    return json_dumps(value, sort_keys=True)
+
+
+class _Palette:
+    """
+    Interns values by content, so that equal values get the same id and can
+    be compared as integers.
+
+    A palette is shared by the Vec3Maps that use it and is retired once it
+    holds MAX_ENTRIES values: maps are moved to the current palette on their
+    next write, and a retired palette is freed with the last map using it.
+    """
+    MAX_ENTRIES = 1 << 14
+
+    def __init__(self):
+        self.values = []
+        self.keys = []
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def id_of(self, value):
+        return self._intern(_palette_key(value), value)
+
+    def _intern(self, key, value):
+        value_id = self._ids.get(key)
+        if value_id is None:
+            with self._lock:
+                value_id = self._ids.get(key)
+                if value_id is None:
+                    # the value is appended before its id is published
+                    self.values.append(value)
+                    self.keys.append(key)
+                    value_id = self._ids[key] = len(self.values) - 1
+        return value_id
+
+    def _map_ids(self, other, ids, lookup):
+        ids = np.asarray(ids, dtype=np.int32)
+        if other is self or len(ids) == 0:
+            return ids
+        unique, inverse = np.unique(ids, return_inverse=True)
+        mapped = np.array([lookup(value_id) if value_id >= 0 else value_id for value_id in unique.tolist()], dtype=np.int32)
+        return mapped[inverse.reshape(-1)]
+
+    def find_ids(self, other, ids):
+        """
+        Returns:
+            ids in this palette of the values of the ids in `other`, -2 where
+            this palette does not hold the value (-1 is kept)
+        """
+        return self._map_ids(other, ids, lambda value_id: self._ids.get(other.keys[value_id], -2))
+
+    def import_ids(self, other, ids):
+        """
+        Like find_ids, but missing values are added.
+        """
+        return self._map_ids(other, ids, lambda value_id: self._intern(other.keys[value_id], other.values[value_id]))
+
+
+_palette = _Palette()
+_palette_lock = threading.Lock()
+
+
+def _current_palette():
+    global _palette
+    if len(_palette.values) >= _Palette.MAX_ENTRIES:
+        with _palette_lock:
+            if len(_palette.values) >= _Palette.MAX_ENTRIES:
+                _palette = _Palette()
+    return _palette
+
+# Vec3Maps of cached states are shared between threads
+_materialize_lock = threading.Lock()
 
 
 class Vec3Map:
-    __slots__ = ("data",)
+    """
+    Map from integer positions to values (block states, chest items, ...).
+
+    Values are interned in a palette and stored as int32 ids in 16x16x16
+    chunks, which are allocated only where there are entries, together with
+    the insertion order used by to_dict(). The `__Vec3Map__` json given to the
+    constructor is parsed on first access, and to_dict() builds the json only
+    when asked. Ids are only comparable between maps with the same palette,
+    see find_ids.
+
+    Values are shared and must not be modified in place.
+    """
+    __slots__ = (
+        "_palette", "_chunks", "_chunk_keys", "_ids", "_seq", "_n_chunks", "_lookup",
+        "_next_seq", "_source", "_owned", "_view", "_index", "_index_dirty",
+    )
 
-    def __init__(self, vec3map):
-        if "__Vec3Map__" in vec3map:
+    SHIFT = 4
+    SIZE = 1 << SHIFT
+    MASK = SIZE - 1
+
+    def __init__(self, vec3map=None):
+        self._palette = _current_palette()
+        # chunk key -> slot in the chunk arrays
+        self._chunks = {}
+        self._chunk_keys = np.zeros((0, 3), dtype=np.int64)
+        self._ids = np.full((0, self.SIZE, self.SIZE, self.SIZE), -1, dtype=np.int32)
+        self._seq = np.zeros((0, self.SIZE, self.SIZE, self.SIZE), dtype=np.int32)
+        self._n_chunks = 0
+        # sorted chunk codes and their slots, for vectorized lookups
+        self._lookup = None
+        self._next_seq = 0
+        self._owned = True
+        self._view = None
+        # spatial index, built on first use and then updated per written chunk
+        self._index = None
+        self._index_dirty = set()
+
+        if vec3map is not None and "__Vec3Map__" in vec3map:
             vec3map = vec3map["__Vec3Map__"]
+        self._source = vec3map or None
 
-        positions = np.array([d["position"] for d in vec3map], dtype=np.float64)
-        keys = _vec2key_array(positions)
-
-        self.data = {}
-        d_items = [ {k: v for k, v in d.items() if k != "position"} for d in vec3map]
-
-        for key_row, val in zip(keys, d_items):
-            self.data[(int(key_row[0]), int(key_row[1]), int(key_row[2]))] = val
+    def _materialize(self):
+        if self._source is None:
+            return
+        with _materialize_lock:
+            source = self._source
+            if source is None:
+                # materialized by another thread
+                return
+            self._materialize_source(source)
+            # cleared last, so that other threads do not see a half-built map
+            self._source = None
+
+    def _materialize_source(self, source):
+        positions = np.array([d["position"] for d in source], dtype=np.float64).astype(np.int64)
+        palette = self._palette = _current_palette()
+        ids = np.empty(len(source), dtype=np.int32)
+        for i, d in enumerate(source):
+            value = {k: v for k, v in d.items() if k != "position"}
+            ids[i] = palette.id_of(value)
+        self._assign(positions, ids)
+
+    def copy(self):
+        """
+        Copy-on-write copy. The chunks are shared until either map is modified.
+        """
+        self._materialize()
+        new = Vec3Map.__new__(Vec3Map)
+        new._palette = self._palette
+        new._chunks = self._chunks
+        new._chunk_keys = self._chunk_keys
+        new._ids = self._ids
+        new._seq = self._seq
+        new._n_chunks = self._n_chunks
+        new._lookup = self._lookup
+        new._next_seq = self._next_seq
+        new._source = None
+        new._view = self._view
+        new._index = self._index
+        new._index_dirty = set(self._index_dirty)
+        new._owned = self._owned = False
+        return new
+
+    def _before_write(self):
+        self._materialize()
+        if not self._owned:
+            # only the allocated chunks are copied, not the bounding box
+            n = self._n_chunks
+            self._chunks = dict(self._chunks)
+            self._chunk_keys = self._chunk_keys[:n].copy()
+            self._ids = self._ids[:n].copy()
+            self._seq = self._seq[:n].copy()
+            self._owned = True
+        palette = _current_palette()
+        if self._palette is not palette:
+            # the palette is retired, move the values to the current one
+            used = self._ids >= 0
+            self._ids[used] = palette.import_ids(self._palette, self._ids[used])
+            self._palette = palette
+            self._index = None
+            self._index_dirty = set()
+        self._view = None
+
+    @staticmethod
+    def _chunk_codes(keys):
+        """
+        Returns:
+            (N,) int64 codes of the chunk keys, and whether each key is within
+            the encodable range (x and z in 24 bits, y in 15 bits)
+        """
+        offset = np.array([1 << 23, 1 << 14, 1 << 23], dtype=np.int64)
+        biased = keys + offset
+        valid = np.all((biased >= 0) & (biased < offset * 2), axis=1)
+        return (biased[:, 0] << 39) | (biased[:, 2] << 15) | biased[:, 1], valid
+
+    def _slots_of(self, keys):
+        """
+        Returns:
+            (N,) slots of the chunk keys, -1 where the chunk is not allocated
+        """
+        if self._n_chunks == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        lookup = self._lookup
+        if lookup is None:
+            codes, _ = self._chunk_codes(self._chunk_keys[:self._n_chunks])
+            order = np.argsort(codes)
+            lookup = self._lookup = (codes[order], order)
+        codes, slots = lookup
+        codes_of_keys, valid = self._chunk_codes(keys)
+        i = np.minimum(np.searchsorted(codes, codes_of_keys), len(codes) - 1)
+        return np.where(valid & (codes[i] == codes_of_keys), slots[i], -1)
+
+    def _allocate(self, keys):
+        """
+        Args:
+            keys: (K, 3) distinct keys of chunks that are not allocated yet
+        """
+        if not np.all(self._chunk_codes(keys)[1]):
+            raise ValueError("Position out of the range of Vec3Map")
+        n, capacity = self._n_chunks, len(self._ids)
+        if n + len(keys) > capacity:
+            capacity = max(2 * capacity, n + len(keys), 4)
+            shape = (capacity, self.SIZE, self.SIZE, self.SIZE)
+            ids = np.full(shape, -1, dtype=np.int32)
+            seq = np.zeros(shape, dtype=np.int32)
+            chunk_keys = np.zeros((capacity, 3), dtype=np.int64)
+            ids[:n], seq[:n], chunk_keys[:n] = self._ids[:n], self._seq[:n], self._chunk_keys[:n]
+            self._ids, self._seq, self._chunk_keys = ids, seq, chunk_keys
+
+        self._chunk_keys[n:n + len(keys)] = keys
+        for slot, key in enumerate(map(tuple, keys.tolist()), n):
+            self._chunks[key] = slot
+        self._n_chunks = n + len(keys)
+        self._lookup = None
+
+    def _assign(self, positions, ids):
+        """
+        Args:
+            positions: (N, 3) int array of distinct positions
+            ids: (N,) palette ids, or -1 to remove
+        """
+        if len(positions) == 0:
+            return
+        ids = np.broadcast_to(np.asarray(ids, dtype=np.int32), (len(positions),))
+        keys = positions >> self.SHIFT
+        slots = self._slots_of(keys)
+        missing = (slots < 0) & (ids >= 0)
+        if np.any(missing):
+            self._allocate(np.unique(keys[missing], axis=0))
+            slots = self._slots_of(keys)
+
+        # removing from a chunk that is not allocated is a no-op
+        present = slots >= 0
+        positions, ids, keys, slots = positions[present], ids[present], keys[present], slots[present]
+
+        if self._index is not None:
+            self._index_dirty.update(map(tuple, np.unique(keys, axis=0).tolist()))
+
+        local = positions & self.MASK
+        cells = (slots, local[:, 0], local[:, 1], local[:, 2])
+        added = (self._ids[cells] < 0) & (ids >= 0)
+        n_added = int(np.count_nonzero(added))
+        if n_added:
+            self._seq[tuple(c[added] for c in cells)] = np.arange(self._next_seq, self._next_seq + n_added)
+            self._next_seq += n_added
+        self._ids[cells] = ids
+
+    def _id_at(self, vec):
+        self._materialize()
+        x, y, z = int(vec[0]), int(vec[1]), int(vec[2])
+        slot = self._chunks.get((x >> self.SHIFT, y >> self.SHIFT, z >> self.SHIFT))
+        if slot is None:
+            return -1
+        return int(self._ids[slot, x & self.MASK, y & self.MASK, z & self.MASK])
 
     def set(self, vec, value):
-        self.data[(int(vec[0]), int(vec[1]), int(vec[2]))] = value
+        self._before_write()
+        self._assign(np.array([[int(vec[0]), int(vec[1]), int(vec[2])]], dtype=np.int64), self._palette.id_of(value))
+
+    def set_ids(self, positions, ids, source=None):
+        """
+        Args:
+            positions: (N, 3) int array of distinct positions
+            ids: (N,) palette ids of the values, or -1 to remove
+            source: map whose palette `ids` refer to, e.g. the map of lookup_ids().
+                None for the palette of this map.
+        """
+        # taken before _before_write, which may move this map (or source) to a new palette
+        source_palette = None if source is None else source._palette
+        self._before_write()
+        if source_palette is not None:
+            ids = self._palette.import_ids(source_palette, ids)
+        self._assign(positions, ids)
+
+    def find_ids(self, source, ids):
+        """
+        Returns:
+            ids in the palette of this map of the values of `ids` of the map
+            `source`, -2 where the palette does not hold the value (-1 is kept)
+        """
+        self._materialize()
+        return self._palette.find_ids(source._palette, ids)
+
+    @property
+    def values(self):
+        """
+        Values of the palette, indexed by the ids of lookup_ids() and diff().
+        """
+        self._materialize()
+        return self._palette.values
 
     def get(self, vec):
-        return self.data[(int(vec[0]), int(vec[1]), int(vec[2]))]
+        value_id = self._id_at(vec)
+        if value_id < 0:
+            raise KeyError(tuple(vec))
+        return self._palette.values[value_id]
 
     def has(self, vec):
-        return (int(vec[0]), int(vec[1]), int(vec[2])) in self.data
+        return self._id_at(vec) >= 0
 
     def delete(self, vec):
-        del self.data[(int(vec[0]), int(vec[1]), int(vec[2]))]
+        if not self.has(vec):
+            raise KeyError(tuple(vec))
+        self.set_ids(np.array([[int(vec[0]), int(vec[1]), int(vec[2])]], dtype=np.int64), -1)
+
+    def lookup_ids(self, positions):
+        """
+        Args:
+            positions: (N, 3) int array
+
+        Returns:
+            (N,) int32 array of palette ids of the values, -1 where there is
+            no value. Equal values have equal ids within a palette.
+        """
+        self._materialize()
+        result = np.full(len(positions), -1, dtype=np.int32)
+        if len(positions) == 0 or self._n_chunks == 0:
+            return result
+        positions = np.asarray(positions, dtype=np.int64)
+        slots = self._slots_of(positions >> self.SHIFT)
+        inside = slots >= 0
+        local = positions[inside] & self.MASK
+        result[inside] = self._ids[slots[inside], local[:, 0], local[:, 1], local[:, 2]]
+        return result
+
+    def spatial_index(self):
+        """
+        Returns:
+            _ChunkIndex of the current content. It is shared and immutable.
+        """
+        self._materialize()
+        with _index_lock:
+            if self._index is None:
+                self._index = _ChunkIndex.build(self)
+            elif self._index_dirty:
+                self._index = self._index.updated(self, self._index_dirty)
+            self._index_dirty = set()
+            return self._index
+
+    def diff(self, other):
+        """
+        Returns:
+            (N, 3) int array of the positions whose values differ, and the (N,)
+            ids of their values in the palettes of self and of other (-1 where
+            absent). Positions of self come first, in insertion order.
+        """
+        self._materialize()
+        other._materialize()
+        if self._ids is other._ids and self._n_chunks == other._n_chunks:
+            # copies that have not been written since
+            empty = np.zeros(0, dtype=np.int32)
+            return np.zeros((0, 3), dtype=np.int64), empty, empty
+
+        positions, ids = self._items()
+        other_positions, other_ids = other._items()
+        ids_in_other = other.lookup_ids(positions)
+        changed = ids != self._palette.find_ids(other._palette, ids_in_other)
+        added = self.lookup_ids(other_positions) < 0
+        return (
+            np.concatenate([positions[changed], other_positions[added]]),
+            np.concatenate([ids[changed], np.full(int(np.count_nonzero(added)), -1, dtype=np.int32)]),
+            np.concatenate([ids_in_other[changed], other_ids[added]]),
+        )
+
+    def _items(self):
+        """
+        Returns:
+            (N, 3) int array of positions and (N,) ids, in insertion order
+        """
+        self._materialize()
+        n = self._n_chunks
+        flat_ids = self._ids[:n].ravel()
+        indices = np.flatnonzero(flat_ids >= 0)
+        indices = indices[np.argsort(self._seq[:n].ravel()[indices], kind="stable")]
+        slots, x, y, z = np.unravel_index(indices, (n, self.SIZE, self.SIZE, self.SIZE))
+        positions = (self._chunk_keys[slots] << self.SHIFT) + np.column_stack([x, y, z])
+        return positions, flat_ids[indices]
+
+    def __len__(self):
+        if self._source is not None:
+            return len(self._source)
+        return int(np.count_nonzero(self._ids[:self._n_chunks] >= 0))
 
     def to_dict(self):
+        # the view is shared until the next write, so callers must not modify it
+        if self._view is not None:
+            return self._view
+
+        positions, ids = self._items()
+        values = self._palette.values
         data = []
         append = data.append
-        for (x, y, z), val in self.data.items():
-            d = {"position": [x, y, z]}
-            d.update(val)
+        for position, value_id in zip(positions.tolist(), ids.tolist()):
+            d = {"position": position}
+            d.update(values[value_id])
             append(d)
-        return {"__Vec3Map__": data}
+        self._view = {"__Vec3Map__": data}
+        return self._view
 
     def keys(self):
-        return [[x, y, z] for (x, y, z) in self.data.keys()]
+        positions, _ = self._items()
+        return positions.tolist()
+
+
+_index_lock = threading.Lock()
+
+
+class _ChunkIndex:
+    """
+    Entries of a Vec3Map grouped by 16x16x16 chunks, together with the chunks
+    containing each block name, so that box, radius and nearest queries only
+    visit the chunks that can hold a result. Immutable: updated() returns a
+    new index sharing the unchanged chunks.
+    """
+    SHIFT = Vec3Map.SHIFT
+    SIZE = Vec3Map.SIZE
+    __slots__ = ("chunks", "name_chunks", "values")
+
+    def __init__(self, chunks, name_chunks, values):
+        self.chunks = chunks  # chunk -> ((k, 3) positions, (k,) ids, names)
+        self.name_chunks = name_chunks  # name -> set of chunks
+        self.values = values  # palette values of the ids
+
+    def _names(self, ids):
+        values = self.values
+        return frozenset(values[value_id].get("name") for value_id in np.unique(ids).tolist())
+
+    @classmethod
+    def build(cls, vec3map):
+        positions, ids = vec3map._items()
+        keys = positions >> cls.SHIFT
+        order = np.lexsort((keys[:, 2], keys[:, 1], keys[:, 0]))
+        positions, ids, keys = positions[order], ids[order], keys[order]
+        starts = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+        bounds = np.concatenate([[0], starts, [len(keys)]]).tolist()
+
+        index = cls({}, {}, vec3map._palette.values)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if start == end:
+                continue
+            key = tuple(keys[start].tolist())
+            names = index._names(ids[start:end])
+            index.chunks[key] = (positions[start:end], ids[start:end], names)
+            for name in names:
+                index.name_chunks.setdefault(name, set()).add(key)
+        return index
+
+    def updated(self, vec3map, dirty_keys):
+        chunks = dict(self.chunks)
+        name_chunks = dict(self.name_chunks)
+        copied = set()
+
+        def name_set(name):
+            if name not in copied:
+                name_chunks[name] = set(name_chunks.get(name, ()))
+                copied.add(name)
+            return name_chunks[name]
+
+        for key in dirty_keys:
+            old = chunks.pop(key, None)
+            if old is not None:
+                for name in old[2]:
+                    name_set(name).discard(key)
+
+            # chunks of the index and of the map are the same
+            slot = vec3map._chunks.get(key)
+            if slot is None:
+                continue
+            region = vec3map._ids[slot]
+            rel = np.argwhere(region >= 0)
+            if len(rel) == 0:
+                continue
+            ids = region[rel[:, 0], rel[:, 1], rel[:, 2]]
+            positions = rel + (np.array(key, dtype=np.int64) << self.SHIFT)
+            names = self._names(ids)
+            chunks[key] = (positions, ids, names)
+            for name in names:
+                name_set(name).add(key)
+
+        for name in copied:
+            if not name_chunks[name]:
+                del name_chunks[name]
+        return _ChunkIndex(chunks, name_chunks, self.values)
+
+    def _candidate_keys(self, names):
+        if names is None:
+            return self.chunks.keys()
+        keys = set()
+        for name in names:
+            keys |= self.name_chunks.get(name, set())
+        return keys
+
+    def _gather(self, keys, names):
+        positions, ids = [], []
+        for key in keys:
+            chunk_positions, chunk_ids, chunk_names = self.chunks[key]
+            if names is not None and not chunk_names <= names:
+                values = self.values
+                wanted = [value_id for value_id in np.unique(chunk_ids).tolist() if values[value_id].get("name") in names]
+                mask = np.isin(chunk_ids, wanted)
+                chunk_positions, chunk_ids = chunk_positions[mask], chunk_ids[mask]
+            positions.append(chunk_positions)
+            ids.append(chunk_ids)
+        if not positions:
+            return np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int32)
+        return np.concatenate(positions), np.concatenate(ids)
+
+    def box(self, lo, hi, names=None):
+        """
+        Returns:
+            (k, 3) positions and (k,) palette ids of the entries within [lo, hi]
+            (inclusive), restricted to the block names `names` if given
+        """
+        names = None if names is None else frozenset(names)
+        lo, hi = np.asarray(lo, dtype=np.int64), np.asarray(hi, dtype=np.int64)
+        lo_key, hi_key = lo >> self.SHIFT, hi >> self.SHIFT
+        candidates = self._candidate_keys(names)
+        n_keys = int(np.prod(np.maximum(hi_key - lo_key + 1, 0)))
+        if n_keys < len(candidates):
+            ranges = [range(a, b + 1) for a, b in zip(lo_key.tolist(), hi_key.tolist())]
+            keys = [(x, y, z) for x in ranges[0] for y in ranges[1] for z in ranges[2] if (x, y, z) in candidates]
+        else:
+            keys = [key for key in candidates if np.all(lo_key <= key) and np.all(np.array(key) <= hi_key)]
+
+        positions, ids = self._gather(keys, names)
+        inside = np.all((positions >= lo) & (positions <= hi), axis=1)
+        return positions[inside], ids[inside]
+
+    def radius(self, center, radius, names=None):
+        """
+        Returns:
+            positions, ids and distances of the entries within `radius` of
+            `center`, nearest first
+        """
+        center = np.asarray(center, dtype=np.float64)
+        positions, ids = self.box(np.floor(center - radius), np.ceil(center + radius), names)
+        dist = np.linalg.norm(positions - center, axis=1)
+        inside = dist <= radius
+        positions, ids, dist = positions[inside], ids[inside], dist[inside]
+        order = np.lexsort((positions[:, 2], positions[:, 1], positions[:, 0], dist))
+        return positions[order], ids[order], dist[order]
+
+    def nearest(self, center, n, names=None):
+        """
+        Returns:
+            positions, ids and distances of the `n` entries nearest to `center`
+        """
+        names = None if names is None else frozenset(names)
+        center = np.asarray(center, dtype=np.float64)
+        keys = list(self._candidate_keys(names))
+        if not keys or n <= 0:
+            return np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0)
+
+        # chunks in order of their distance from center, until no closer entry can follow
+        chunk_lo = np.array(keys, dtype=np.float64) * self.SIZE
+        gap = np.maximum(np.maximum(chunk_lo - center, center - (chunk_lo + self.SIZE - 1)), 0)
+        chunk_dist = np.linalg.norm(gap, axis=1)
+        positions, ids, dist = np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0)
+        for i in np.argsort(chunk_dist, kind="stable").tolist():
+            if len(dist) >= n and chunk_dist[i] > dist[n - 1]:
+                break
+            chunk_positions, chunk_ids = self._gather([keys[i]], names)
+            positions = np.concatenate([positions, chunk_positions])
+            ids = np.concatenate([ids, chunk_ids])
+            dist = np.linalg.norm(positions - center, axis=1)
+            order = np.lexsort((positions[:, 2], positions[:, 1], positions[:, 0], dist))[:n]
+            positions, ids, dist = positions[order], ids[order], dist[order]
+        return positions, ids, dist
+
+
+class _EventLog:
+    """
+    Append-only list of (tick, events) shared between snapshots. A snapshot
+    sees the first `length` entries, so appending at the tip never affects
+    older snapshots.
+    """
+    __slots__ = ("entries", "length", "_view", "_index")
+
+    def __init__(self, events=None):
+        self.entries = list((events or {}).items())
+        self.length = len(self.entries)
+        self._view = None
+        self._index = None
+
+    def copy(self):
+        new = _EventLog.__new__(_EventLog)
+        new.entries = self.entries
+        new.length = self.length
+        new._view = self._view
+        new._index = self._index
+        return new
+
+    def append(self, tick, events_at_tick):
+        if len(self.entries) != self.length:
+            # another snapshot has appended after this one
+            self.entries = self.entries[:self.length]
+            self._index = None
+        self.entries.append((tick, events_at_tick))
+        self.length += 1
+        self._view = None
+
+    def index(self):
+        """
+        Returns:
+            (_EventIndex, number of entries seen by this snapshot). The index
+            belongs to `entries` and is shared by the snapshots appending to it.
+        """
+        if self._index is None:
+            self._index = _EventIndex()
+        self._index.extend(self.entries)
+        return self._index, self.length
 
+    def to_dict(self):
+        if self._view is None:
+            self._view = dict(self.entries[:self.length])
+        return self._view
 
-def get_obs_file_info(branch_ckpt_dir, type_, mode, agent_name=None, use_cache=True):
 
-    if use_cache:
-        files = loader._cached_listdir(branch_ckpt_dir)
-    else:
-        files = os.listdir(branch_ckpt_dir)
+def _event_agent_name(e):
+    if e.get("eventName") == "chat":
+        return (e.get("visible") or {}).get("agentName")
+    return e.get("agentName")
 
-    if agent_name is None:
-        regex = re.compile(rf"^{re.escape(type_)}#(-?\d+)\.json$")
-    else:
-        # .internal
-        regex = re.compile(rf"^{re.escape(agent_name)}#{re.escape(type_)}#(-?\d+)\.json$")
-    
-    result = []
-    for file in files:
-        match = regex.match(file)
+
+def _event_matches(key, e):
+    event_names, excluded, agent_name, required_key = key
+    name = e.get("eventName")
+    return (
+        (event_names is None or name in event_names)
+        and (excluded is None or name not in excluded)
+        and (agent_name is None or _event_agent_name(e) == agent_name)
+        and (required_key is None or required_key in e)
+    )
+
+
+class _EventIndex:
+    """
+    Events of a state in tick order, with the positions of the events of each
+    event name and of each agent. Ticks are indexed once, as the events grow.
+    Queries combining several conditions get their own position list, built
+    on first use and then extended with the new events.
+    """
+
+    def __init__(self):
+        self.events = []  # all events, flattened
+        self.event_ticks = []
+        self.entry_starts = [0]  # position in `events` of the first event of each tick
+        self.by_name = {}  # eventName -> positions in `events`
+        self.by_agent = {}  # agentName -> positions in `events`
+        self.by_query = {}  # (event_names, excluded, agent_name, required_key) -> positions in `events`
+        self._lock = threading.Lock()
+
+    def extend(self, entries):
+        if len(self.entry_starts) > len(entries):
+            return
+        with self._lock:
+            for tick, events_at_tick in entries[len(self.entry_starts) - 1:]:
+                tick = int(tick)
+                for e in events_at_tick:
+                    i = len(self.events)
+                    self.events.append(e)
+                    self.event_ticks.append(tick)
+                    self.by_name.setdefault(e.get("eventName"), []).append(i)
+                    self.by_agent.setdefault(_event_agent_name(e), []).append(i)
+                    for key, group in self.by_query.items():
+                        if _event_matches(key, e):
+                            group.append(i)
+                self.entry_starts.append(len(self.events))
+
+    def _group(self, key):
+        event_names, excluded, agent_name, required_key = key
+        if excluded is None and required_key is None:
+            if event_names is None and agent_name is None:
+                return range(len(self.events))
+            if event_names is None:
+                return self.by_agent.get(agent_name, [])
+            if agent_name is None and len(event_names) == 1:
+                return self.by_name.get(next(iter(event_names)), [])
+        group = self.by_query.get(key)
+        if group is None:
+            group = self.by_query[key] = [i for i, e in enumerate(self.events) if _event_matches(key, e)]
+        return group
+
+    def select(self, event_names=None, excluded=None, agent_name=None, required_key=None, since=None, last=None, length=None):
+        """
+        Args:
+            event_names: event names to select. None for all.
+            excluded: event names not to select
+            agent_name: only the events of this agent
+            required_key: only the events having this key, e.g. "hidden"
+            since: only the events at or after this tick
+            last: only the last N of the selected events
+            length: number of ticks to consider, from the first one
+
+        Returns:
+            list of (tick, event) in tick order
+        """
+        key = (
+            None if event_names is None else frozenset(event_names),
+            frozenset(excluded) if excluded else None,
+            agent_name,
+            required_key,
+        )
+        with self._lock:
+            end = self.entry_starts[len(self.entry_starts) - 1 if length is None else length]
+            start = 0 if since is None else bisect_left(self.event_ticks, since, 0, end)
+
+            group = self._group(key)
+            lo, hi = bisect_left(group, start), bisect_left(group, end)
+            if last is not None:
+                lo = max(lo, hi - last) if last > 0 else hi
+            return [(self.event_ticks[i], self.events[i]) for i in group[lo:hi]]
+
+
+class BeliefState(Mapping):
+    """
+    Copy-on-write state of a branch. It reads like the state json
+    ({"blocks": ..., "containers": ..., "status": ..., "events": ...}), while
+    copy() shares all unchanged structures with the original.
+
+    `status` entries are replaced, never modified in place.
+    """
+    __slots__ = ("blocks", "containers", "status", "events", "extra")
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.blocks = Vec3Map(state.get("blocks"))
+        self.containers = Vec3Map(state.get("containers"))
+        self.status = state.get("status", {})
+        self.events = _EventLog(state.get("events"))
+        self.extra = {k: v for k, v in state.items() if k not in ["blocks", "containers", "status", "events"]}
+
+    def copy(self):
+        new = BeliefState.__new__(BeliefState)
+        new.blocks = self.blocks.copy()
+        new.containers = self.containers.copy()
+        new.status = self.status
+        new.events = self.events.copy()
+        new.extra = self.extra
+        return new
+
+    def __getitem__(self, key):
+        if key == "blocks":
+            return self.blocks.to_dict()
+        if key == "containers":
+            return self.containers.to_dict()
+        if key == "status":
+            return self.status
+        if key == "events":
+            return self.events.to_dict()
+        return self.extra[key]
+
+    def __iter__(self):
+        yield from ["blocks", "containers", "status", "events"]
+        yield from self.extra
+
+    def __len__(self):
+        return 4 + len(self.extra)
+
+    def to_dict(self):
+        return dict(self)
+
+
+# checkpoint files are json, or npz converted by ckpt_converter
+_OBS_FILE_REGEX = re.compile(r"^(?:(.+)#)?([^#]+)#(-?\d+)\.(?:json|npz)$")
+
+
+def _update_obs_file_index(index, added, removed):
+    """
+    Args:
+        index: (type, agent_name) -> ([tick, ...], [{"filename": ..., "tick": ...}, ...], all file infos)
+        added, removed: changed filenames
+
+    Returns:
+        updated copy of index. Unchanged lists are shared. If both json and
+        npz files exist for a tick, the json one is listed.
+    """
+    changes = {}
+    for filename, is_added in [(f, True) for f in added] + [(f, False) for f in removed]:
+        match = _OBS_FILE_REGEX.match(filename)
         if match:
-            result.append({
-                "filename": file,
-                "tick": int(match.group(1))
-            })
-    
-    result.sort(key=lambda x: x["tick"])
-    
-    if len(result) == 0 and mode != "list":
-        return {"filename": None, "tick": None}
-    
-    if mode == "list":
-        return result  # [{'filename': ..., 'tick': ...}, ...]
-    elif mode == "new":
-        return result[-1] if result else None  # {'filename': ..., 'tick': ...}
-    elif mode == "old":
-        return result[0] if result else None  # {'filename': ..., 'tick': ...}
-    
+            agent_name, type_, tick = match.groups()
+            changes.setdefault((type_, agent_name), []).append((filename, int(tick), is_added))
+
+    if not changes:
+        return index
+
+    index = dict(index)
+    for key, key_changes in changes.items():
+        removed_names = {filename for filename, _, is_added in key_changes if not is_added}
+        all_infos = [info for info in index.get(key, ([], [], []))[2] if info["filename"] not in removed_names]
+        all_infos += [{"filename": filename, "tick": tick} for filename, tick, is_added in key_changes if is_added]
+        if not all_infos:
+            index.pop(key, None)
+            continue
+
+        all_infos.sort(key=lambda x: (x["tick"], not x["filename"].endswith(".json")))
+        infos = [info for i, info in enumerate(all_infos) if i == 0 or all_infos[i - 1]["tick"] != info["tick"]]
+        index[key] = ([info["tick"] for info in infos], infos, all_infos)
+    return index
+
+
+def get_obs_file_info(branch_ckpt_dir, type_, mode, agent_name=None, use_cache=True, tick=None):
+    return get_loader().get_obs_file_info(branch_ckpt_dir, type_, mode, agent_name=agent_name, use_cache=use_cache, tick=tick)
+
 
 def get_main_agent_name(branch_str):
     main_agent_name = branch_str.split(".")[-1].split("[")[0]
@@ -586,42 +2093,100 @@ def get_main_agent_name(branch_str):
     return main_agent_name
 
 
-def can_agent_see_block(branch_str, block_pos, tick=None):
+def get_block_visibility(branch_str, tick=None):
+    """
+    Returns:
+        (Vec3BoolMap of the blocks visible at `tick`, or at the latest tick if
+        None, tick of the visibility data). Ticks without block visibility use
+        the last earlier tick with it.
+    """
     if tick is not None:
-        history_at_tick, t = loader.get_history(branch_str, tick)
+        history_at_tick, t = get_loader().get_history(branch_str, tick)
     else:
-        history_at_tick, t = loader.get_latest_history(branch_str)
+        history_at_tick, t = get_loader().get_latest_history(branch_str)
 
+    if history_at_tick is None:
+        raise Exception(f"No history data found in branch '{branch_str}' at tick '{t}'.")
     if "visibility" not in history_at_tick:
         raise Exception(f"No visibility data found in branch '{branch_str}' at tick '{t}'. Visibility is not recorded in non-'follow' branches.")
 
     if "blocks" not in history_at_tick["visibility"]:
-        history_at_tick, t = loader.get_previous_block_vis(branch_str, t)
+        history_at_tick, t = get_loader().get_previous_block_vis(branch_str, t)
         if history_at_tick is None:
             raise Exception(f'Failed to get history of block visibility in branch "{branch_str}".')
 
     try:
-        block_vis = history_at_tick["visibility"]["blocks"]
-        vec3boolmap = Vec3BoolMap(
-            (np.array(block_vis["__Vec3BoolMap__"]["range"][0]["__Vec3__"]),
-             np.array(block_vis["__Vec3BoolMap__"]["range"][1]["__Vec3__"]))
-        )
-        vec3boolmap.from_base64(block_vis["__Vec3BoolMap__"]["base64"])
+        return Vec3BoolMap.from_json(history_at_tick["visibility"]["blocks"]), t
+    except:
+        raise Exception(f'Cannot get block visibility data in branch "{branch_str}" at tick "{t}".')
+
+
+def can_agent_see_block(branch_str, block_pos, tick=None):
+    vec3boolmap, t = get_block_visibility(branch_str, tick)
+    try:
         return vec3boolmap.has(np.array(block_pos))
     except:
         raise Exception(f'Cannot get block visibility data in branch "{branch_str}" at tick "{t}".')
 
 
-def get_last_seen_block_info(branch_str, block_pos):
-    state, _ = loader.get_latest_state(branch_str)
+def can_agent_see_blocks(branch_str, positions, ticks=None):
+    """
+    Batched can_agent_see_block.
 
-    block_pos_arr = np.array(block_pos)
+    Args:
+        positions: (N, 3) int array
+        ticks: None for the latest tick, one tick for all positions, or (N,) ticks
 
-    for block in state["blocks"]["__Vec3Map__"]:
-        if np.sum(np.abs(block_pos_arr - np.array(block["position"]))) == 0:
-            return block
-            
-    return None
+    Returns:
+        (N,) bool array
+    """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+    if ticks is None or np.ndim(ticks) == 0:
+        vec3boolmap, _ = get_block_visibility(branch_str, None if ticks is None else int(ticks))
+        return vec3boolmap.has_array(positions)
+
+    ticks = np.asarray(ticks, dtype=np.int64)
+    if ticks.shape != (len(positions),):
+        raise ValueError(f"Expected {len(positions)} ticks, got an array of shape {ticks.shape}.")
+
+    # the visibility is resolved once per distinct tick, and positions whose
+    # ticks resolve to the same visibility data are looked up together
+    unique_ticks, inverse = np.unique(ticks, return_inverse=True)
+    groups = {}
+    for i, tick in enumerate(unique_ticks.tolist()):
+        vec3boolmap, t = get_block_visibility(branch_str, tick)
+        groups.setdefault(t, (vec3boolmap, []))[1].append(i)
+
+    result = np.zeros(len(positions), dtype=bool)
+    for vec3boolmap, tick_indices in groups.values():
+        mask = np.isin(inverse, tick_indices)
+        result[mask] = vec3boolmap.has_array(positions[mask])
+    return result
+
+
+def _status_inventory(agent_status):
+    try:
+        return agent_status["hidden"]["inventory"]
+    except (KeyError, TypeError):
+        return None
+
+
+def _status_position(agent_status):
+    try:
+        return agent_status["visible"]["position"]["__Vec3__"]
+    except (KeyError, TypeError):
+        return None
+
+
+def get_last_seen_block_info(branch_str, block_pos):
+    state, _ = get_loader().get_latest_state(branch_str)
+    blocks = get_loader()._state_vec3map(state, "blocks")
+    if not blocks.has(block_pos):
+        return None
+
+    block = {"position": [int(x) for x in block_pos]}
+    block.update(blocks.get(block_pos))
+    return block
 
 def update_state(
     tick: int,
@@ -632,17 +2197,16 @@ def update_state(
     position_state_mode = "last_seen",
     has_inventory_info = None,
 ):
+    """
+    Args:
+        state: BeliefState updated in place
+    """
     status = filtered_history["status"]
     events = filtered_history["events"]
 
-    block_state_map = Vec3Map(state["blocks"])
+    block_state_map = state.blocks
     
-    block_vis = filtered_history["visibility"]["blocks"]
-    block_visibility_from_agent = Vec3BoolMap(
-        (np.array(block_vis["__Vec3BoolMap__"]["range"][0]["__Vec3__"]),
-         np.array(block_vis["__Vec3BoolMap__"]["range"][1]["__Vec3__"]))
-    )
-    block_visibility_from_agent.from_base64(block_vis["__Vec3BoolMap__"]["base64"])
+    block_visibility_from_agent = Vec3BoolMap.from_json(filtered_history["visibility"]["blocks"])
 
     _update_status_state(
         state=state,
@@ -653,30 +2217,33 @@ def update_state(
         position_state_mode=position_state_mode,
     )
 
-    updated_blocks = []
-
-    for visible_pos in block_visibility_from_agent.get_all():
-        if obj_block_state_map.has(visible_pos):
-            obj_state_block = obj_block_state_map.get(visible_pos)
-
-            if not block_state_map.has(visible_pos) or obj_state_block != block_state_map.get(visible_pos):
-                block_state_map.set(visible_pos, obj_state_block)
-                updated_blocks.append(
-                    {
-                        "position": visible_pos,
-                        "name": obj_state_block.get("name"),
-                        "properties": obj_state_block.get("properties"),
-                    }
-                )
-
-    state["blocks"] = block_state_map.to_dict()
+    visible_positions = block_visibility_from_agent.get_all_array()
+    obj_ids = obj_block_state_map.lookup_ids(visible_positions)
+    belief_ids = block_state_map.lookup_ids(visible_positions)
+    changed = (obj_ids >= 0) & (block_state_map.find_ids(obj_block_state_map, obj_ids) != belief_ids)
+
+    changed_positions = visible_positions[changed]
+    changed_ids = obj_ids[changed]
+    if len(changed_positions):
+        # a write unshares the map of a copied state, so only write changes
+        block_state_map.set_ids(changed_positions, changed_ids, source=obj_block_state_map)
+
+    obj_values = obj_block_state_map.values
+    obj_state_blocks = [obj_values[value_id] for value_id in changed_ids.tolist()]
+
+    updated_blocks = [
+        {
+            "position": pos,
+            "name": obj_state_block.get("name"),
+            "properties": obj_state_block.get("properties"),
+        }
+        for pos, obj_state_block in zip(changed_positions.tolist(), obj_state_blocks)
+    ]
 
     _update_container_state(state, events, updated_blocks, block_state_map)
 
     if events:
-        state["events"][tick] = []
-        for e in events:
-            state["events"][tick].append(e)
+        state.events.append(tick, list(events))
 
 
 def _update_container_state(
@@ -685,7 +2252,7 @@ def _update_container_state(
     updated_blocks,
     block_state_map,
 ):
-    container_state_map = Vec3Map(state["containers"])
+    container_state_map = state.containers
 
     for b in updated_blocks:
         if b.get("name") == "chest" and not container_state_map.has(b["position"]):
@@ -709,7 +2276,8 @@ def _update_container_state(
 
         chest_items = {}
         if container_state_map.has(pos):
-            chest_items = container_state_map.get(pos)
+            # values may be shared with other snapshots
+            chest_items = dict(container_state_map.get(pos))
 
         if e["eventName"] == "getItemFromChest":
             for item_name, count in e.get("visible", {}).get("gotItems", {}).items():
@@ -730,8 +2298,6 @@ def _update_container_state(
             raise ValueError(f'Invalid event name "{e["eventName"]}"')
 
         container_state_map.set(pos, chest_items)
-        
-    state["containers"] = container_state_map.to_dict()
 
 
 def _update_status_state(
@@ -746,44 +2312,52 @@ def _update_status_state(
     events = events or []
     has_inventory_info = has_inventory_info or {}
 
-    state.setdefault("status", {})
+    # entries may be shared with other snapshots, so they are copied before being changed
+    status_state = dict(state.status)
 
     agent_names = set(agent_list)
 
     for agent_name in agent_names:
-        if agent_name not in state["status"]:
-            state["status"][agent_name] = {"visible": {}, "hidden": {}}
+        if agent_name not in status_state:
+            agent_state = {"visible": {}, "hidden": {}}
+        else:
+            agent_state = dict(status_state[agent_name])
 
         if agent_name in status:
-            state["status"][agent_name]["visible"] = copy.deepcopy(status[agent_name].get("visible", {}))
+            agent_state["visible"] = copy.deepcopy(status[agent_name].get("visible", {}))
             if status[agent_name].get("hidden"):
-                state["status"][agent_name]["hidden"] = copy.deepcopy(status[agent_name]["hidden"])
+                agent_state["hidden"] = copy.deepcopy(status[agent_name]["hidden"])
         else:
             if position_state_mode == "last_seen":
                 pass
             elif position_state_mode == "current":
-                mem_vis = state["status"][agent_name].setdefault("visible", {})
+                mem_vis = dict(agent_state.get("visible", {}))
                 mem_vis["position"] = None
                 mem_vis["velocity"] = None
                 mem_vis["yaw"] = None
                 mem_vis["pitch"] = None
                 mem_vis["onGround"] = None
+                agent_state["visible"] = mem_vis
             else:
                 raise ValueError(f'Invalid value of position_state_mode "{position_state_mode}"')
 
-        state["status"][agent_name].setdefault("hidden", {})
-        state["status"][agent_name]["hidden"].setdefault("inventory", {})
+        hidden = dict(agent_state.get("hidden", {}))
+        hidden["inventory"] = dict(hidden.get("inventory", {}))
+        agent_state["hidden"] = hidden
+        status_state[agent_name] = agent_state
+
+    state.status = status_state
 
     def _add(agent_name: str, name: str, count: int):
         if has_inventory_info.get(agent_name):
             return
-        inv = state["status"][agent_name]["hidden"]["inventory"]
+        inv = status_state[agent_name]["hidden"]["inventory"]
         inv[name] = inv.get(name, 0) + count
 
     def _remove(agent_name: str, name: str, count: int):
         if has_inventory_info.get(agent_name):
             return
-        inv = state["status"][agent_name]["hidden"]["inventory"]
+        inv = status_state[agent_name]["hidden"]["inventory"]
         if name not in inv:
             return
         inv[name] -= count
@@ -891,7 +2465,7 @@ def filter_events(
 #### FILTER DIFINITION ####
 
 def position(branch_str, agent_name=None, ignore_last_seen=True):
-    latest_state, _ = loader.get_latest_state(branch_str)
+    latest_state, _ = get_loader().get_latest_state(branch_str)
     try:
         main_agent_name = get_main_agent_name(branch_str)
     except:
@@ -903,7 +2477,7 @@ def position(branch_str, agent_name=None, ignore_last_seen=True):
 
     try:
         if main_agent_name and agent_name != main_agent_name and ignore_last_seen:
-            history_at_tick, _  = loader.get_latest_history(branch_str)
+            history_at_tick, _  = get_loader().get_latest_history(branch_str)
             if 'visibility' in history_at_tick:
                 can_see_agent = history_at_tick['visibility']['players'][agent_name]
                 if not can_see_agent:
@@ -913,30 +2487,27 @@ def position(branch_str, agent_name=None, ignore_last_seen=True):
     except:
         return "No data"
     
-def thought(branch_str):
-    latest_state, _ = loader.get_latest_state(branch_str)
+def _select_events(branch_str, event_names=None, excluded=None, agent_name=None, required_key=None, since=None, last=None):
+    latest_state, _ = get_loader().get_latest_state(branch_str)
+    index, length = get_loader()._state_event_index(latest_state)
+    return index.select(
+        event_names, excluded=excluded, agent_name=agent_name, required_key=required_key, since=since, last=last, length=length
+    )
+
+def thought(branch_str, since=None, last=None):
     string = ""
-    for tick, events in latest_state["events"].items():
-        for e in events:
-            if e["eventName"] != "think":
-                continue
-            if "hidden" not in e:
-                continue
-            string += f't={tick}   {e["agentName"]} thought "{e["hidden"]["msg"]}"\n'
+    for tick, e in _select_events(branch_str, ["think"], required_key="hidden", since=since, last=last):
+        string += f't={tick}   {e["agentName"]} thought "{e["hidden"]["msg"]}"\n'
 
     if not string:
         string = "No thought"
 
     return string
 
-def chat_log(branch_str):
-    latest_state, _ = loader.get_latest_state(branch_str)
+def chat_log(branch_str, since=None, last=None):
     string = ""
-    for tick, events in latest_state["events"].items():
-        for e in events:
-            if e["eventName"] != "chat":
-                continue
-            string += f't={tick}   {e["visible"]["agentName"]} said "{e["visible"]["msg"]}"\n'
+    for tick, e in _select_events(branch_str, ["chat"], since=since, last=last):
+        string += f't={tick}   {e["visible"]["agentName"]} said "{e["visible"]["msg"]}"\n'
 
     if not string:
         string = "No chats"
@@ -944,7 +2515,7 @@ def chat_log(branch_str):
     return string
 
 def inventory(branch_str, agent_name=None):
-    latest_state, _ = loader.get_latest_state(branch_str)
+    latest_state, _ = get_loader().get_latest_state(branch_str)
     if agent_name is None:
         agent_name = get_main_agent_name(branch_str)
 
@@ -957,7 +2528,7 @@ def inventory(branch_str, agent_name=None):
         return "No data"
     
 def equipment(branch_str, agent_name=None):
-    latest_state, _ = loader.get_latest_state(branch_str)
+    latest_state, _ = get_loader().get_latest_state(branch_str)
     if agent_name is None:
         agent_name = get_main_agent_name(branch_str)
 
@@ -970,7 +2541,7 @@ def equipment(branch_str, agent_name=None):
         return "No data"
     
 def helditem(branch_str, agent_name=None):
-    latest_state, _ = loader.get_latest_state(branch_str)
+    latest_state, _ = get_loader().get_latest_state(branch_str)
     if agent_name is None:
         agent_name = get_main_agent_name(branch_str)
 
@@ -980,7 +2551,7 @@ def helditem(branch_str, agent_name=None):
         return "No data"
 
 def chests(branch_str):
-    latest_state, _ = loader.get_latest_state(branch_str)
+    latest_state, _ = get_loader().get_latest_state(branch_str)
     chests = {}
     for dic in latest_state["containers"]["__Vec3Map__"]:
         pos = tuple(dic["position"])
@@ -998,7 +2569,7 @@ def chests(branch_str):
 
 
 def other_players(branch_str):
-    latest_state, _ = loader.get_latest_state(branch_str)
+    latest_state, _ = get_loader().get_latest_state(branch_str)
     main_agent_name = get_main_agent_name(branch_str)
 
     dic = {}
@@ -1014,7 +2585,7 @@ def other_players(branch_str):
 
 
 def blocks(branch_str, block_names=None):
-    latest_state, _ = loader.get_latest_state(branch_str)
+    latest_state, _ = get_loader().get_latest_state(branch_str)
     all_blocks = latest_state["blocks"]["__Vec3Map__"]
 
     if block_names is None:
@@ -1040,36 +2611,53 @@ def blocks(branch_str, block_names=None):
 def blocks_and_visibilities(branch_str, block_names=None, other_branch_str_list=[]):
     assert isinstance(other_branch_str_list, list)
 
+    loader = get_loader()
     latest_state, _ = loader.get_latest_state(branch_str)
     all_blocks = latest_state["blocks"]["__Vec3Map__"]
 
     if block_names is None:
         block_names = list(set(map(lambda b:b['name'], all_blocks)))
-    
+
+    positions_by_name = {name: [] for name in block_names}
+    for b in all_blocks:
+        if b["name"] in positions_by_name:
+            positions_by_name[b["name"]].append(tuple(b["position"]))
+
+    # one block map and one decoded bitmap per branch, queried for all positions at once
+    other_maps = {}
+    visibilities = {}
+
+    def visible_now(branch_str, positions):
+        if branch_str not in visibilities:
+            visibilities[branch_str] = get_block_visibility(branch_str)[0]
+        return visibilities[branch_str].has_array(positions).tolist()
+
     string = ""
     for name in block_names:
         string += f'{name} visibilities:'
 
-        info = {}
-        for b in all_blocks:
-            if b["name"] != name:
-                continue
-            pos = tuple(b["position"])
-            pos_str = str(pos)
-            info[pos_str] = {}
-            block_info_from_me = get_last_seen_block_info(branch_str, pos)
-            info[pos_str]["Me"] = {
-                "seen_before": (block_info_from_me is not None),
-                "visible_now": can_agent_see_block(branch_str, pos)
-            }
+        pos_list = positions_by_name[name]
+        info = {str(pos): {} for pos in pos_list}
+        if pos_list:
+            positions = np.array(pos_list, dtype=np.int64)
+            for pos, visible in zip(pos_list, visible_now(branch_str, positions)):
+                info[str(pos)]["Me"] = {
+                    "seen_before": True,
+                    "visible_now": visible
+                }
 
             for other_branch_str in other_branch_str_list:
                 agent_name = get_main_agent_name(other_branch_str)
-                block_info = get_last_seen_block_info(other_branch_str, pos)
-                info[pos_str][f"{agent_name} from me"] = {
-                    "seen_before": (block_info is not None and block_info["name"] == block_info_from_me["name"]),
-                    "visible_now": can_agent_see_block(other_branch_str, pos)
-                }
+                if other_branch_str not in other_maps:
+                    other_state, _ = loader.get_latest_state(other_branch_str)
+                    other_maps[other_branch_str] = loader._state_vec3map(other_state, "blocks")
+                other_ids = other_maps[other_branch_str].lookup_ids(positions).tolist()
+                values = other_maps[other_branch_str].values
+                for pos, value_id, visible in zip(pos_list, other_ids, visible_now(other_branch_str, positions)):
+                    info[str(pos)][f"{agent_name} from me"] = {
+                        "seen_before": (value_id >= 0 and values[value_id].get("name") == name),
+                        "visible_now": visible
+                    }
 
         if len(info) > 0:
             string += json.dumps(info, indent=2) + "\n"
@@ -1081,7 +2669,7 @@ def blocks_and_visibilities(branch_str, block_names=None, other_branch_str_list=
 
 def block_property(branch_str, block_name):
     assert isinstance(block_name, str)
-    latest_state, _ = loader.get_latest_state(branch_str)
+    latest_state, _ = get_loader().get_latest_state(branch_str)
     all_blocks = latest_state["blocks"]["__Vec3Map__"]
 
     string = ""
@@ -1093,6 +2681,64 @@ def block_property(branch_str, block_name):
 
     return string
 
+def _resolve_center(state, center):
+    """
+    Args:
+        center: agent name or [x, y, z]
+    """
+    if isinstance(center, str):
+        return _status_position(state["status"].get(center))
+    return list(center)
+
+def _group_by_name(positions, ids, dists, block_names, values):
+    grouped = {} if block_names is None else {name: [] for name in block_names}
+    for pos, value_id, dist in zip(positions.tolist(), ids.tolist(), dists):
+        grouped.setdefault(values[value_id].get("name"), []).append((tuple(pos), dist))
+
+    string = ""
+    for name, entries in grouped.items():
+        string += f'{name}:\n'
+        if entries:
+            string += "".join(f"{pos}\n" if dist is None else f"{pos} distance: {dist:.1f}\n" for pos, dist in entries)
+        else:
+            string += "Not observed\n"
+    return string
+
+def blocks_in_box(branch_str, corner1, corner2, block_names=None):
+    latest_state, _ = get_loader().get_latest_state(branch_str)
+    index = get_loader()._state_vec3map(latest_state, "blocks").spatial_index()
+
+    lo, hi = np.minimum(corner1, corner2), np.maximum(corner1, corner2)
+    positions, ids = index.box(lo, hi, block_names)
+    order = np.lexsort((positions[:, 2], positions[:, 1], positions[:, 0]))
+    return _group_by_name(positions[order], ids[order], [None] * len(order), block_names, index.values)
+
+def blocks_within(branch_str, center, radius, block_names=None):
+    latest_state, _ = get_loader().get_latest_state(branch_str)
+    center = _resolve_center(latest_state, center)
+    if center is None:
+        return "No data"
+    index = get_loader()._state_vec3map(latest_state, "blocks").spatial_index()
+
+    positions, ids, dists = index.radius(center, radius, block_names)
+    return _group_by_name(positions, ids, dists.tolist(), block_names, index.values)
+
+def nearest_blocks(branch_str, center, n=1, block_names=None):
+    latest_state, _ = get_loader().get_latest_state(branch_str)
+    center = _resolve_center(latest_state, center)
+    if center is None:
+        return "No data"
+    index = get_loader()._state_vec3map(latest_state, "blocks").spatial_index()
+
+    positions, ids, dists = index.nearest(center, n, block_names)
+    if len(positions) == 0:
+        return "Not observed\n"
+    values = index.values
+    string = ""
+    for pos, value_id, dist in zip(positions.tolist(), ids.tolist(), dists.tolist()):
+        string += f'{values[value_id].get("name")} {tuple(pos)} distance: {dist:.1f}\n'
+    return string
+
 def _event_to_description(e):
     event_name = e['eventName']
     if event_name == "depositItemIntoChest":
@@ -1139,25 +2785,17 @@ def _event_to_description(e):
     
     return description
 
-def events(branch_str):
-    latest_state, _ = loader.get_latest_state(branch_str)
+def events(branch_str, agent_name=None, since=None, last=None):
     string = "time;action;agent_name;description\n"
-    for tick, events_at_tick in latest_state["events"].items():
-        for e in events_at_tick:
-            event_name = e['eventName']
-            if event_name in ["think", "blockUpdate"]:
-                continue
-            if event_name == "chat":
-                agent_name = e["visible"]["agentName"]
-            else:
-                agent_name = e["agentName"]
-            description = _event_to_description(e)
-            string += f'{tick};{event_name};{agent_name};{description}\n'
+    for tick, e in _select_events(branch_str, excluded=["think", "blockUpdate"], agent_name=agent_name, since=since, last=last):
+        event_name = e['eventName']
+        description = _event_to_description(e)
+        string += f'{tick};{event_name};{_event_agent_name(e)};{description}\n'
 
     return string
 
-def events_and_visibilities(branch_str, agent_name_i_have=None):
-    latest_state, _ = loader.get_latest_state(branch_str)
+def events_and_visibilities(branch_str, agent_name_i_have=None, since=None, last=None):
+    agent_names = get_agent_names()
     if not agent_name_i_have:
         agent_name_i_have = get_main_agent_name(branch_str)
 
@@ -1165,29 +2803,26 @@ def events_and_visibilities(branch_str, agent_name_i_have=None):
     
     visibility = {}
     event_info_list = []
-    for tick, events_at_tick in latest_state["events"].items():
-        tick = int(tick)
-        for e in events_at_tick:
-            event_name = e['eventName']
-            if event_name in ["think", "blockUpdate"]:
-                continue
-
-            if event_name == "chat":
-                agent_name = e["visible"]["agentName"]
-            else:
-                agent_name = e["agentName"]
+    for tick, e in _select_events(branch_str, excluded=["think", "blockUpdate"], since=since, last=last):
+        event_name = e['eventName']
+        if event_name == "chat":
+            agent_name = e["visible"]["agentName"]
+        else:
+            agent_name = e["agentName"]
 
-            description = _event_to_description(e)
+        description = _event_to_description(e)
 
-            event_info_list.append({
-                "tick": tick,
-                "agent_name": agent_name,
-                "event_name": event_name,
-                "description": description
-            })
+        event_info_list.append({
+            "tick": tick,
+            "agent_name": agent_name,
+            "event_name": event_name,
+            "description": description
+        })
 
+        if tick in visibility:
+            continue
         visibility[tick] = {}
-        history_at_tick, _  = loader.get_history(branch_str, tick)
+        history_at_tick, _  = get_loader().get_history(branch_str, tick)
         for saw_agent_name in agent_names:
             if 'visibility' not in history_at_tick:
                 visibility[tick][saw_agent_name] = "####"
@@ -1233,6 +2868,9 @@ FILTERS = [
     blocks,
     blocks_and_visibilities,
     block_property,
+    blocks_in_box,
+    blocks_within,
+    nearest_blocks,
     events,
     events_and_visibilities,
 ]
@@ -1241,24 +2879,91 @@ FILTER_DICT = {f.__name__: f for f in FILTERS}
 
 #### END FILTER DIFINITION ####
 
-def initialize_observation_loader(ckpt_dir, t_agent_names):
-    global loader, agent_names
-    loader = ObservationLoader(ckpt_dir)
-    agent_names = t_agent_names
+def initialize_observation_loader(ckpt_dir, t_agent_names, **loader_kwargs):
+    """
+    Creates a loader of ckpt_dir, registers it and makes it the default loader.
+    Loaders of other ckpt_dirs stay registered with their caches. A loader
+    previously registered for the same ckpt_dir is closed.
+
+    Returns:
+        the created ObservationLoader
+    """
+    loader = ObservationLoader(ckpt_dir, agent_names=t_agent_names, **loader_kwargs)
+    register_loader(loader)
+    return loader
 
-def get_loader():
+def register_loader(loader, default=True):
+    global _default_loader
+    key = os.path.abspath(loader.ckpt_dir)
+    old_loader = _loaders.get(key)
+    if old_loader is not None and old_loader is not loader:
+        old_loader.close()
+        if _default_loader is old_loader:
+            _default_loader = None
+    _loaders[key] = loader
+    if default or _default_loader is None:
+        _default_loader = loader
+
+def unregister_loader(loader):
+    """
+    Removes a loader from the registry and closes it.
+    """
+    global _default_loader
+    key = os.path.abspath(loader.ckpt_dir)
+    if _loaders.get(key) is loader:
+        del _loaders[key]
+    if _default_loader is loader:
+        _default_loader = next(reversed(_loaders.values()), None)
+    loader.close()
+
+def get_loader(ckpt_dir=None):
+    """
+    Returns:
+        the loader registered for ckpt_dir, or if ckpt_dir is None, the loader
+        bound by `use_loader` or by the running filter, or the default loader
+    """
+    if ckpt_dir is not None:
+        loader = _loaders.get(os.path.abspath(ckpt_dir))
+        if not loader:
+            raise Exception(f"No observation loader is registered for '{ckpt_dir}'.")
+        return loader
+
+    loader = _current_loader.get() or _default_loader
     if not loader:
         raise Exception("Call `initialize_observation_loader` before calling `get_loader`.")
     return loader
 
 def get_agent_names():
+    agent_names = get_loader().agent_names
     if not agent_names:
         raise Exception("Call `initialize_observation_loader` before calling `get_agent_names`.")
     return agent_names
 
-def load_from_template(template, variables={}, extra_filters=[], allow_filter_override=False):
-    if not loader:
-        raise Exception("Call `initialize_observation_loader` before calling `load_from_template`.")
+@contextlib.contextmanager
+def use_loader(loader):
+    """
+    Binds `loader` to the filters and helpers called in the with-block.
+    """
+    token = _current_loader.set(loader)
+    try:
+        yield loader
+    finally:
+        _current_loader.reset(token)
+
+def _bind_loader(f, loader):
+    @functools.wraps(f)
+    def bound_filter(*args, **kwargs):
+        with use_loader(loader):
+            return f(*args, **kwargs)
+    return bound_filter
+
+def create_environment(loader=None, extra_filters=[], allow_filter_override=False):
+    """
+    Creates a jinja environment whose filters read observations through `loader`
+    (the default loader if None).
+    """
+    if loader is None:
+        loader = get_loader()
 
     env = Environment(
             undefined=StrictUndefined,
@@ -1273,10 +2978,15 @@ def load_from_template(template, variables={}, extra_filters=[], allow_filter_ov
         if overridden_keys:
             raise Exception(f"Cannot override filters. Set allow_filter_override=True to override filters. Overriden: {', '.join(overridden_keys)}")
 
-    env.filters = dict(
+    filters = dict(
             **FILTER_DICT,
             **extra_filter_dict
         )
+    env.filters = {name: _bind_loader(f, loader) for name, f in filters.items()}
+    return env
+
+def load_from_template(template, variables={}, extra_filters=[], allow_filter_override=False, loader=None):
+    env = create_environment(loader, extra_filters=extra_filters, allow_filter_override=allow_filter_override)
     template = env.from_string(template)
     rendered_content = template.render(variables)
 
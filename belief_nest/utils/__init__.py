@@ -1,3 +1,4 @@
 from .file_utils import *
 from .json_utils import *
+from .cache_utils import LRUCache, SingleFlight, estimate_size
 from .log_utils import SessionHTTPHandler, JsonFormatter, MethodLogging, create_logger, remove_all_handlers
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+Cache utils.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+
+def estimate_size(obj, sample=16):
+    """
+    Estimate of the memory held by a json tree of dicts, lists and scalars, in bytes.
+    Lists longer than `sample` are estimated from `sample` evenly spaced elements.
+    Dict keys are not counted, since the json parsers share them between objects.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for value in obj.values():
+            size += estimate_size(value, sample)
+    elif isinstance(obj, list) and obj:
+        if len(obj) <= sample:
+            size += sum(estimate_size(value, sample) for value in obj)
+        else:
+            step = len(obj) / sample
+            sampled = sum(estimate_size(obj[int(i * step)], sample) for i in range(sample))
+            size += int(sampled * len(obj) / sample)
+    return size
+
+
+class LRUCache:
+    """
+    Least-recently-used cache bounded by total size and/or number of entries.
+    All methods are thread-safe.
+
+    Args:
+        max_bytes: upper bound of the summed `size` of all entries. None for no bound.
+        max_entries: upper bound of the number of entries. None for no bound.
+    """
+
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key, default=None):
+        """
+        Get a value without touching the LRU order or the counters.
+        """
+        item = self._data.get(key)
+        return default if item is None else item[0]
+
+    def put(self, key, value, size=1):
+        with self._lock:
+            if key in self._data:
+                self.total_bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.total_bytes += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            self.total_bytes -= item[1]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.total_bytes = 0
+
+    def _evict(self):
+        # keep the newest entry even if it alone exceeds max_bytes
+        while len(self._data) > 1 and (
+            (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            or (self.max_entries is not None and len(self._data) > self.max_entries)
+        ):
+            _, (_, size) = self._data.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return self._stats()
+
+    def _stats(self):
+        return {
+            "entries": len(self._data),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function, and the others wait for it and get its result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,153 @@
+"""
+Compact binary encoding of checkpoint files (state#T.json, history#T.json).
+
+The json tree is stored as compact json in an npz container, except for
+    __Vec3Map__: a palette of the distinct values, int32 positions and int32 palette ids
+    __Vec3BoolMap__: the raw bitmap bytes instead of base64
+whose arrays of all occurrences are concatenated into a few npz members.
+Decoding gives back the same json tree, except that entries of a Vec3Map
+with equal values share the nested objects of the value.
+"""
+import json
+import base64
+import zipfile
+
+import numpy as np
+
+
+CKPT_NPZ_EXT = ".npz"
+CKPT_NPZ_VERSION = 1
+
+
+def _is_int_vec3(vec):
+    return isinstance(vec, list) and len(vec) == 3 and all(type(x) is int for x in vec)
+
+
+class _Packer:
+    def __init__(self):
+        self.positions = []
+        self.ids = []
+        self.n_entries = 0
+        self.bitmaps = []
+        self.n_bitmap_bytes = 0
+
+    def pack(self, obj):
+        if isinstance(obj, dict):
+            if len(obj) == 1 and "__Vec3Map__" in obj:
+                packed = self._pack_vec3map(obj["__Vec3Map__"])
+                if packed is not None:
+                    return packed
+            if len(obj) == 1 and "__Vec3BoolMap__" in obj:
+                packed = self._pack_vec3boolmap(obj["__Vec3BoolMap__"])
+                if packed is not None:
+                    return packed
+            if "__npz__" in obj:
+                raise ValueError("'__npz__' is a reserved key")
+            return {k: self.pack(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [self.pack(v) for v in obj]
+        return obj
+
+    def _pack_vec3map(self, items):
+        if not isinstance(items, list) or not all(isinstance(d, dict) and _is_int_vec3(d.get("position")) for d in items):
+            return None
+        positions = np.array([d["position"] for d in items], dtype=np.int64).reshape(-1, 3)
+        if positions.size and (positions.min() < np.iinfo(np.int32).min or positions.max() > np.iinfo(np.int32).max):
+            return None
+
+        palette = {}
+        ids = []
+        for d in items:
+            value = json.dumps({k: v for k, v in d.items() if k != "position"}, ensure_ascii=False)
+            ids.append(palette.setdefault(value, len(palette)))
+
+        start = self.n_entries
+        self.positions.append(positions.astype(np.int32))
+        self.ids.append(np.array(ids, dtype=np.int32))
+        self.n_entries += len(items)
+        return {"__npz__": "Vec3Map", "span": [start, self.n_entries], "palette": list(palette)}
+
+    def _pack_vec3boolmap(self, vec3boolmap):
+        try:
+            raw = base64.b64decode(vec3boolmap["base64"], validate=True)
+        except (KeyError, TypeError, ValueError):
+            return None
+        if len(vec3boolmap) != 2 or base64.b64encode(raw).decode("ascii") != vec3boolmap["base64"]:
+            return None
+
+        start = self.n_bitmap_bytes
+        self.bitmaps.append(np.frombuffer(raw, dtype=np.uint8))
+        self.n_bitmap_bytes += len(raw)
+        return {"__npz__": "Vec3BoolMap", "span": [start, self.n_bitmap_bytes], "range": vec3boolmap["range"]}
+
+
+def dump_ckpt_npz(obj, fp):
+    """
+    Args:
+        obj: json tree of a checkpoint file
+        fp: file path or binary file object
+    """
+    packer = _Packer()
+    tree = packer.pack(obj)
+    skeleton = json.dumps({"version": CKPT_NPZ_VERSION, "tree": tree}, ensure_ascii=False, separators=(",", ":"))
+
+    np.savez_compressed(
+        fp,
+        skeleton=np.frombuffer(skeleton.encode("utf-8"), dtype=np.uint8),
+        positions=np.concatenate(packer.positions) if packer.positions else np.zeros((0, 3), dtype=np.int32),
+        ids=np.concatenate(packer.ids) if packer.ids else np.zeros(0, dtype=np.int32),
+        bitmaps=np.concatenate(packer.bitmaps) if packer.bitmaps else np.zeros(0, dtype=np.uint8),
+    )
+
+
+def load_ckpt_npz(fp):
+    """
+    Args:
+        fp: file path or binary file object
+
+    Returns:
+        json tree of the checkpoint file
+    """
+    with np.load(fp, allow_pickle=False) as npz:
+        skeleton = npz["skeleton"].tobytes().decode("utf-8")
+        positions = npz["positions"].tolist()
+        ids = npz["ids"].tolist()
+        bitmaps = npz["bitmaps"].tobytes()
+
+    def unpack(obj):
+        kind = obj.get("__npz__")
+        if kind == "Vec3Map":
+            palette = [json.loads(value) for value in obj["palette"]]
+            start, end = obj["span"]
+            items = []
+            for position, value_id in zip(positions[start:end], ids[start:end]):
+                d = {"position": position}
+                d.update(palette[value_id])
+                items.append(d)
+            return {"__Vec3Map__": items}
+        if kind == "Vec3BoolMap":
+            start, end = obj["span"]
+            return {"__Vec3BoolMap__": {
+                "range": obj["range"],
+                "base64": base64.b64encode(bitmaps[start:end]).decode("ascii"),
+            }}
+        return obj
+
+    # the tree is rebuilt while parsing, so no second walk over it is needed
+    skeleton = json.loads(skeleton, object_hook=lambda obj: unpack(obj) if "__npz__" in obj else obj)
+    if skeleton.get("version") != CKPT_NPZ_VERSION:
+        raise ValueError(f"Unsupported checkpoint encoding version: {skeleton.get('version')}")
+    return skeleton["tree"]
+
+
+def is_ckpt_npz(filepath):
+    return str(filepath).endswith(CKPT_NPZ_EXT)
+
+
+def ckpt_npz_size(filepath):
+    """
+    Returns:
+        uncompressed size of the npz members, comparable to the size of the json file
+    """
+    with zipfile.ZipFile(filepath) as zf:
+        return sum(info.file_size for info in zf.infolist())
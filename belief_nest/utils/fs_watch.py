@@ -0,0 +1,168 @@
+"""
+Directory watchers used to invalidate cached directory listings.
+
+Both watchers share the same interface:
+    watch(dir_path): start (or restart) tracking a directory. Call it right
+        before listing the directory.
+    is_valid(dir_path): False if the directory may have changed since the
+        last watch(dir_path).
+"""
+import os
+import sys
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+import weakref
+
+
+# inotify(7) constants
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (
+    IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingDirWatcher:
+    """
+    Detects changes by comparing the mtime of the directory, which changes
+    whenever an entry is created, deleted or renamed. A listing taken within
+    `racy_sec` of the last modification is not trusted, because a second
+    change inside the same timestamp granule would go unnoticed.
+    """
+
+    mode = "poll"
+
+    def __init__(self, racy_sec=2.0):
+        self.racy_ns = int(racy_sec * 1e9)
+        self._signatures = {}  # dir_path -> (mtime_ns, watched_at_ns)
+
+    def watch(self, dir_path):
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            self._signatures.pop(dir_path, None)
+            return
+        self._signatures[dir_path] = (mtime_ns, time.time_ns())
+
+    def is_valid(self, dir_path):
+        signature = self._signatures.get(dir_path)
+        if signature is None:
+            return False
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return False
+        watched_mtime_ns, watched_at_ns = signature
+        return mtime_ns == watched_mtime_ns and watched_at_ns - mtime_ns > self.racy_ns
+
+    def close(self):
+        self._signatures.clear()
+
+
+class InotifyDirWatcher:
+    """
+    Linux inotify watcher. Events are drained synchronously in is_valid(), so
+    a change made before the call (e.g. by the mineflayer server before it
+    answers /dumpObservation) is always seen, and an unchanged directory
+    costs a single non-blocking read.
+    """
+
+    mode = "inotify"
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._fd = fd
+        self._finalizer = weakref.finalize(self, os.close, fd)
+
+        self._wd_to_dir = {}
+        self._dir_to_wd = {}
+        self._dirty = set()
+
+    def watch(self, dir_path):
+        self._drain()
+        self._dirty.discard(dir_path)
+        if dir_path in self._dir_to_wd:
+            return
+        wd = self._add_watch(self._fd, os.fsencode(dir_path), _WATCH_MASK)
+        if wd < 0:
+            # e.g. the directory does not exist (yet); it stays invalid
+            self._dirty.add(dir_path)
+            return
+        self._wd_to_dir[wd] = dir_path
+        self._dir_to_wd[dir_path] = wd
+
+    def is_valid(self, dir_path):
+        self._drain()
+        return dir_path in self._dir_to_wd and dir_path not in self._dirty
+
+    def _drain(self):
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, name_len = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size + name_len
+
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, so nothing can be trusted any more
+                    self._dirty.update(self._dir_to_wd)
+                    continue
+
+                dir_path = self._wd_to_dir.get(wd)
+                if dir_path is None:
+                    continue
+                self._dirty.add(dir_path)
+
+                if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    del self._wd_to_dir[wd]
+                    del self._dir_to_wd[dir_path]
+
+    def close(self):
+        self._finalizer()
+        self._wd_to_dir.clear()
+        self._dir_to_wd.clear()
+
+
+def create_dir_watcher(mode="auto"):
+    """
+    Args:
+        mode: "inotify", "poll", or "auto" to use inotify where available
+            and fall back to polling otherwise
+    """
+    if mode == "poll":
+        return PollingDirWatcher()
+    if mode == "inotify":
+        return InotifyDirWatcher()
+    if mode == "auto":
+        try:
+            return InotifyDirWatcher()
+        except (OSError, AttributeError):
+            return PollingDirWatcher()
+    raise ValueError(f"Invalid watch mode '{mode}'")
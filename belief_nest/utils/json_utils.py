@@ -1,21 +1,79 @@
 import json
+import math
 import re
 from typing import Any, Dict, Union
 from .file_utils import f_join
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# fast json codec used by json_load(s)/json_dump(s). Falls back to the stdlib
+# for inputs or options orjson does not support.
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def _orjson_option(kwargs):
+    """
+    Returns: orjson option equivalent to the stdlib json.dumps kwargs, or None if unsupported
+    """
+    option = orjson.OPT_NON_STR_KEYS
+    for key, value in kwargs.items():
+        if key == "indent" and value in (None, 2):
+            if value == 2:
+                option |= orjson.OPT_INDENT_2
+        elif key == "sort_keys":
+            if value:
+                option |= orjson.OPT_SORT_KEYS
+        elif key == "ensure_ascii":
+            # orjson writes utf-8, which decodes to the same data
+            pass
+        else:
+            return None
+    return option
+
+
+def _has_non_finite(data):
+    """
+    Returns: whether data holds NaN or Infinity, which orjson writes as null
+    """
+    if isinstance(data, float):
+        return not math.isfinite(data)
+    if isinstance(data, dict):
+        return any(_has_non_finite(v) or _has_non_finite(k) for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        return any(_has_non_finite(v) for v in data)
+    return False
+
 
 def json_load(*file_path, **kwargs):
     file_path = f_join(file_path)
-    with open(file_path, "r") as fp:
-        return json.load(fp, **kwargs)
+    with open(file_path, "rb") as fp:
+        return json_loads(fp.read(), **kwargs)
 
 
 def json_loads(string, **kwargs):
+    """
+    Args:
+        string: str or bytes
+    """
+    if orjson is not None and not kwargs:
+        try:
+            return orjson.loads(string)
+        except orjson.JSONDecodeError:
+            # e.g. NaN or integers beyond 64 bits, which the stdlib accepts
+            pass
     return json.loads(string, **kwargs)
 
 
 def json_dump(data, *file_path, **kwargs):
     file_path = f_join(file_path)
+    if orjson is not None and _orjson_option(kwargs) is not None:
+        with open(file_path, "w", encoding="utf-8") as fp:
+            fp.write(json_dumps(data, **kwargs))
+        return
     with open(file_path, "w") as fp:
         json.dump(data, fp, **kwargs)
 
@@ -24,6 +82,16 @@ def json_dumps(data, **kwargs):
     """
     Returns: string
     """
+    if orjson is not None:
+        option = _orjson_option(kwargs)
+        if option is not None:
+            try:
+                dumped = orjson.dumps(data, option=option)
+            except orjson.JSONEncodeError:
+                pass
+            else:
+                if b"null" not in dumped or not _has_non_finite(data):
+                    return dumped.decode("utf-8")
     return json.dumps(data, **kwargs)
 
 
@@ -1,6 +1,7 @@
 import json
 import requests
 import functools
+import inspect
 import types
 from logging import getLogger, FileHandler, Formatter, INFO, Logger
 from logging.handlers import HTTPHandler
@@ -37,6 +38,20 @@ class MethodLogging:
         
         if not isinstance(attr, types.MethodType) or name == "__init__":
             return attr
+
+        if inspect.iscoroutinefunction(attr):
+            # logged when the coroutine runs, not when it is created
+            @functools.wraps(attr)
+            async def async_wrapper(*args, **kwargs):
+                class_name = self.__class__.__name__
+                if not hasattr(self, 'logger'):
+                    raise AttributeError(f"{class_name} requires 'self.logger' to be defined before any method calls. Please define 'self.logger' in the constructor.")
+                self.logger.debug(f"Calling method: {class_name}.{name}")
+                result = await attr(*args, **kwargs)
+                self.logger.debug(f"Finished method: {class_name}.{name}")
+                return result
+
+            return async_wrapper
             
         @functools.wraps(attr)
         def wrapper(*args, **kwargs):
@@ -0,0 +1,73 @@
+"""
+Compare the parsers on the checkpoint files of a checkpoint directory.
+
+    python benchmarks/bench_json_codec.py <ckpt_dir> [--repeat N]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+import yaml
+
+from belief_nest.utils.json_utils import json_loads, JSON_BACKEND
+
+
+CKPT_FILE_REGEX = re.compile(r"^(?:[a-zA-Z0-9_]+#)?(?:state|history)#-?\d+\.json$")
+
+
+def _bench(fn, datas, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for data in datas:
+            fn(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ckpt_dir")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-files", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    names = []
+    datas = []
+    for root, dirs, files in os.walk(args.ckpt_dir):
+        dirs[:] = sorted(d for d in dirs if d != ".keyframes")
+        for filename in sorted(files):
+            if CKPT_FILE_REGEX.match(filename) and len(datas) < args.max_files:
+                with open(os.path.join(root, filename), "rb") as f:
+                    datas.append(f.read())
+                names.append(filename)
+    if not datas:
+        parser.error(f"No checkpoint files in '{args.ckpt_dir}'")
+    total_mb = sum(len(d) for d in datas) / 1024**2
+    print(f"{len(datas)} files, {total_mb:.1f} MiB")
+
+    results = [
+        ("json (stdlib)", _bench(lambda d: json.loads(d), datas, args.repeat)),
+        (f"json_loads ({JSON_BACKEND})", _bench(json_loads, datas, args.repeat)),
+    ]
+    for name, sec in results:
+        print(f"{name:24s} {sec:8.3f} s  {total_mb / sec:8.1f} MiB/s")
+
+    # previous parser of get_state. yaml does not accept the tab indentation of
+    # the files written by the mineflayer server, so they are compared re-indented
+    # with spaces. yaml is slow enough that one round is plenty
+    states = [json.dumps(json.loads(d), indent=2).encode("utf-8") for name, d in zip(names, datas) if name.startswith("state#")]
+    if states:
+        state_mb = sum(len(d) for d in states) / 1024**2
+        print(f"{len(states)} state files re-indented, {state_mb:.1f} MiB")
+        for name, sec in [
+            ("yaml.safe_load", _bench(lambda d: yaml.safe_load(d.decode("utf-8")), states, 1)),
+            (f"json_loads ({JSON_BACKEND})", _bench(json_loads, states, args.repeat)),
+        ]:
+            print(f"{name:24s} {sec:8.3f} s  {state_mb / sec:8.1f} MiB/s")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -10,7 +10,10 @@ tmp = {}
 with open(f"{PKG_NAME}/version.py") as f:
     exec(f.read(), tmp)
 VERSION = tmp["__version__"]
-EXTRAS = {}
+EXTRAS = {
+    "fast-json": ["orjson"],
+    "async": ["httpx"],
+}
 
 
 def _read_file(fname):